@@ -4,13 +4,26 @@ from sqlalchemy import inspect, text
 from sqlalchemy.orm import sessionmaker
 from db_control.mymodels_MySQL import (
     Base, CashierMaster, TaxMaster, ProductMaster, 
-    TransactionData, TransactionDetail
+    TransactionData, TransactionDetail, PromotionMaster, PromotionItem, PriceChangeLog, InventoryData
 )
 from db_control.connect_MySQL import engine
-from datetime import datetime
+from db_control.partitioning import (
+    is_partitioning_enabled, enable_partitioning, ensure_transaction_indexes
+)
+from datetime import datetime, time
 import hashlib
 
 
+def ensure_price_change_log_columns(conn):
+    """
+    既存DBの price_change_log に後から追加した列が無ければ追加（create_all は既存テーブルに列を追加しないため）
+    """
+    existing = {column["name"] for column in inspect(conn).get_columns(PriceChangeLog.__tablename__)}
+    if "product_name" not in existing:
+        print("列追加: price_change_log.product_name")
+        conn.execute(text("ALTER TABLE price_change_log ADD COLUMN product_name VARCHAR(200) NULL AFTER barcode"))
+
+
 def init_db():
     """
     データベースの初期化
@@ -58,6 +71,20 @@ def init_db():
         print(f"❌ テーブル作成エラー: {e}")
         raise
     
+    # 取引データの複合インデックス・パーティション
+    print("🗂️ 取引データのインデックス・パーティションを確認中...")
+    try:
+        with engine.connect() as conn:
+            ensure_transaction_indexes(conn)
+            ensure_price_change_log_columns(conn)
+            if is_partitioning_enabled():
+                enable_partitioning(conn)
+            conn.commit()
+        print("✅ インデックス・パーティション確認完了")
+    except Exception as e:
+        print(f"❌ インデックス・パーティション作成エラー: {e}")
+        raise
+    
     # 初期データ投入
     print("📊 初期データを投入中...")
     insert_sample_data()
@@ -119,6 +146,57 @@ def insert_sample_data():
             if not existing:
                 session.add(ProductMaster(**product))
         
+        # 4. プロモーションマスタの投入
+        print("🏷️ プロモーションマスタデータ投入...")
+        promotion_data = [
+            {"promotion_id": "PR001", "promotion_name": "ボールペン・えんぴつ 2点で180円", "promotion_type": "MULTI_BUY",
+             "required_quantity": 2, "promo_price": 180, "start_datetime": datetime(2024, 1, 1), "priority": 20},
+            {"promotion_id": "PR002", "promotion_name": "ノート・したじきセット 350円", "promotion_type": "BUNDLE",
+             "promo_price": 350, "start_datetime": datetime(2024, 1, 1), "priority": 10},
+            {"promotion_id": "PR003", "promotion_name": "夕方セール 消しゴム20%引", "promotion_type": "TIME_DISCOUNT",
+             "discount_rate": 0.2000, "start_datetime": datetime(2024, 1, 1),
+             "daily_start_time": time(17, 0), "daily_end_time": time(20, 0), "priority": 30}
+        ]
+        promotion_item_data = [
+            {"promotion_id": "PR001", "barcode": "4901827364514"},
+            {"promotion_id": "PR001", "barcode": "4901111222223"},
+            {"promotion_id": "PR002", "barcode": "4901111222227", "quantity": 1},
+            {"promotion_id": "PR002", "barcode": "4901234567894", "quantity": 1},
+            {"promotion_id": "PR003", "barcode": "4902102141147"}
+        ]
+        
+        for promotion in promotion_data:
+            existing = session.query(PromotionMaster).filter_by(promotion_id=promotion["promotion_id"]).first()
+            if not existing:
+                session.add(PromotionMaster(**promotion))
+        
+        for item in promotion_item_data:
+            existing = session.query(PromotionItem).filter_by(
+                promotion_id=item["promotion_id"], barcode=item["barcode"]
+            ).first()
+            if not existing:
+                session.add(PromotionItem(**item))
+        
+        # 5. 在庫データの投入（店舗30、一部は発注点以下で在庫僅少一覧に表示される）
+        print("📦 在庫データ投入...")
+        inventory_data = [
+            {"store_code": "30", "barcode": "4901234567894", "quantity": 40, "reorder_point": 10},
+            {"store_code": "30", "barcode": "4902102141147", "quantity": 120, "reorder_point": 30},
+            {"store_code": "30", "barcode": "4901111222223", "quantity": 150, "reorder_point": 30},
+            {"store_code": "30", "barcode": "4902222333336", "quantity": 2, "reorder_point": 3},
+            {"store_code": "30", "barcode": "4901827364514", "quantity": 200, "reorder_point": 50},
+            {"store_code": "30", "barcode": "4901111222227", "quantity": 80, "reorder_point": 20},
+            {"store_code": "30", "barcode": "4909876543212", "quantity": 5, "reorder_point": 5},
+            {"store_code": "30", "barcode": "4901010202027", "quantity": 30, "reorder_point": 10}
+        ]
+        
+        for inventory in inventory_data:
+            existing = session.query(InventoryData).filter_by(
+                store_code=inventory["store_code"], barcode=inventory["barcode"]
+            ).first()
+            if not existing:
+                session.add(InventoryData(**inventory))
+        
         # コミット
         session.commit()
         print("✅ 初期データ投入完了!")
@@ -127,11 +205,15 @@ def insert_sample_data():
         tax_count = session.query(TaxMaster).count()
         cashier_count = session.query(CashierMaster).count()
         product_count = session.query(ProductMaster).count()
+        promotion_count = session.query(PromotionMaster).count()
+        inventory_count = session.query(InventoryData).count()
         
         print(f"📊 投入データ確認:")
         print(f"   - 税マスタ: {tax_count}件")
         print(f"   - レジ担当者: {cashier_count}件")
         print(f"   - 商品マスタ: {product_count}件")
+        print(f"   - プロモーション: {promotion_count}件")
+        print(f"   - 在庫データ: {inventory_count}件")
         
     except Exception as e:
         session.rollback()
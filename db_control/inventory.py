@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+在庫引当（購入時の在庫減算）
+
+売れ筋商品の行ロック競合とデッドロックを避けるため、
+- 購入内の明細をバーコード単位に集約し
+- (店舗コード, バーコード) 順に並べた1回の executemany で UPDATE する
+任意で、複数の購入を短い時間窓でまとめて減算するバッチャーも提供する。
+バッチ反映モードでは減算を減算待ちテーブルへ購入と同じトランザクションで記録するため、
+ワーカーが停止・強制終了しても減算は失われない（次に起動したバッチャーが反映する）。
+"""
+
+import threading
+from typing import Dict, Iterable, List, Tuple
+
+from sqlalchemy import bindparam, delete, func, insert, select, update
+
+from db_control.mymodels_MySQL import InventoryData, InventoryPendingDecrement
+
+_inventory = InventoryData.__table__
+_pending = InventoryPendingDecrement.__table__
+
+# 1回の反映で処理する減算待ちの最大件数
+FLUSH_LIMIT = 5000
+
+# 1回の executemany で使う在庫減算文（行ロックの取得順を固定するため呼び出し側で並べ替える）
+_DECREMENT_STOCK = update(_inventory).where(
+    _inventory.c.store_code == bindparam("b_store_code"),
+    _inventory.c.barcode == bindparam("b_barcode")
+).values(
+    quantity=_inventory.c.quantity - bindparam("b_quantity")
+)
+
+
+def aggregate_quantities(items: Iterable[Tuple[str, int]]) -> List[Tuple[str, int]]:
+    """
+    (バーコード, 数量) をバーコード単位に集約し、バーコード順に並べる
+    """
+    totals: Dict[str, int] = {}
+    for barcode, quantity in items:
+        totals[barcode] = totals.get(barcode, 0) + quantity
+    return sorted((barcode, quantity) for barcode, quantity in totals.items() if quantity)
+
+
+def _execute_decrements(db, rows: List[Tuple[str, str, int]]):
+    if not rows:
+        return
+    db.execute(_DECREMENT_STOCK, [
+        {"b_store_code": store_code, "b_barcode": barcode, "b_quantity": quantity}
+        for store_code, barcode, quantity in rows
+    ])
+
+
+def decrement_stock(db, store_code: str, items: Iterable[Tuple[str, int]]):
+    """
+    購入分の在庫を減算（呼び出し側のトランザクション内で実行）
+    在庫データの無い商品は在庫管理対象外として何もしない
+    """
+    _execute_decrements(db, [
+        (store_code, barcode, quantity) for barcode, quantity in aggregate_quantities(items)
+    ])
+
+
+def enqueue_decrements(db, store_code: str, items: Iterable[Tuple[str, int]]):
+    """
+    購入分の減算を減算待ちテーブルへ記録（呼び出し側のトランザクション内で実行）
+    追記のみのため、売れ筋商品の在庫行をロックしない
+    """
+    rows = [
+        {"store_code": store_code, "barcode": barcode, "quantity": quantity}
+        for barcode, quantity in aggregate_quantities(items)
+    ]
+    if rows:
+        db.execute(insert(_pending), rows)
+
+
+def get_low_stock(db, store_code: str, limit: int = 100):
+    """
+    発注点以下の在庫一覧（在庫数の少ない順）
+    """
+    return db.query(InventoryData).filter(
+        InventoryData.store_code == store_code,
+        InventoryData.quantity <= InventoryData.reorder_point
+    ).order_by(
+        InventoryData.quantity, InventoryData.barcode
+    ).limit(limit).all()
+
+
+class InventoryBatcher:
+    """
+    減算待ちテーブルの減算を時間窓ごとにまとめて在庫へ反映するバッチャー
+
+    購入トランザクション内で enqueue_decrements() した減算を、window_seconds ごとに
+    (店舗コード, バーコード) 単位で合算して反映し、反映した減算待ちを同じトランザクションで削除する。
+    反映に失敗した場合はロールバックされ、減算待ちは次回の反映で処理される。
+    複数ワーカーのバッチャーが同時に動いても、減算待ちは行ロック（SKIP LOCKED）で重複なく分担する。
+    """
+
+    def __init__(self, session_factory, window_seconds: float):
+        self._session_factory = session_factory
+        self._window_seconds = window_seconds
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.drain()
+
+    def flush(self) -> int:
+        """
+        減算待ちを最大 FLUSH_LIMIT 件反映し、処理した件数を返す（失敗時は0）
+        """
+        db = self._session_factory()
+        try:
+            # 上限IDまでに限定し、反映中に追加される減算待ちのINSERTを待たせない
+            last_id = db.execute(select(func.max(_pending.c.pending_id))).scalar()
+            if last_id is None:
+                return 0
+            pending = db.execute(
+                select(_pending.c.pending_id, _pending.c.store_code, _pending.c.barcode, _pending.c.quantity)
+                .where(_pending.c.pending_id <= last_id)
+                .order_by(_pending.c.pending_id)
+                .limit(FLUSH_LIMIT)
+                .with_for_update(skip_locked=True)
+            ).all()
+            if not pending:
+                db.rollback()
+                return 0
+
+            totals: Dict[Tuple[str, str], int] = {}
+            for _, store_code, barcode, quantity in pending:
+                key = (store_code, barcode)
+                totals[key] = totals.get(key, 0) + quantity
+            rows = sorted(
+                (store_code, barcode, quantity)
+                for (store_code, barcode), quantity in totals.items() if quantity
+            )
+            _execute_decrements(db, rows)
+            db.execute(delete(_pending).where(_pending.c.pending_id.in_([row[0] for row in pending])))
+            db.commit()
+            return len(pending)
+        except Exception as e:
+            db.rollback()
+            print(f"在庫減算エラー（次回に再実行）: {str(e)}")
+            return 0
+        finally:
+            db.close()
+
+    def drain(self):
+        """
+        減算待ちが無くなるまで反映（失敗した場合は次回に持ち越す）
+        """
+        while self.flush() >= FLUSH_LIMIT:
+            pass
+
+    def _run(self):
+        while not self._stopped.wait(self._window_seconds):
+            self.drain()
+
+
+if __name__ == "__main__":
+    # 同時購入ストレステスト: python -m db_control.inventory
+    # DATABASE_URL のMySQLに対し、明細ごとのUPDATE（従来方式）と集約・整列済みUPDATEを比較する。
+    # 店舗コード "BENCH" の在庫データを作成し、終了時に削除する。
+    import random
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from sqlalchemy import text
+    from sqlalchemy.exc import OperationalError
+    from sqlalchemy.orm import sessionmaker
+    from db_control.connect_MySQL import engine
+    from db_control.mymodels_MySQL import ProductMaster
+
+    THREADS = 16
+    PURCHASES = 400
+    STORE = "BENCH"
+
+    engine.echo = False
+    Session = sessionmaker(bind=engine)
+
+    with Session() as db:
+        barcodes = [b for (b,) in db.query(ProductMaster.barcode).limit(20).all()]
+        if not barcodes:
+            raise SystemExit("商品マスタが空です。create_tables_MySQL を先に実行してください")
+        db.query(InventoryData).filter(InventoryData.store_code == STORE).delete()
+        db.add_all([InventoryData(store_code=STORE, barcode=b, quantity=10 ** 9, reorder_point=0) for b in barcodes])
+        db.commit()
+
+    # 売れ筋（先頭数件）に偏ったカートを生成
+    hot = barcodes[:3]
+    random.seed(0)
+    carts = [
+        [(random.choice(hot if random.random() < 0.7 else barcodes), 1) for _ in range(random.randint(3, 15))]
+        for _ in range(PURCHASES)
+    ]
+
+    def naive(db, cart):
+        for barcode, quantity in cart:
+            db.execute(
+                text("UPDATE inventory_data SET quantity = quantity - :q WHERE store_code = :s AND barcode = :b"),
+                {"q": quantity, "s": STORE, "b": barcode}
+            )
+
+    def aggregated(db, cart):
+        decrement_stock(db, STORE, cart)
+
+    def lock_status():
+        with engine.connect() as conn:
+            rows = conn.execute(text("SHOW GLOBAL STATUS LIKE 'Innodb_row_lock%'")).all()
+        return {name: int(value) for name, value in rows}
+
+    def run(label, decrement):
+        deadlocks = 0
+        waits = []
+
+        def purchase(cart):
+            nonlocal deadlocks
+            db = Session()
+            try:
+                start = time.perf_counter()
+                decrement(db, cart)
+                db.commit()
+                waits.append(time.perf_counter() - start)
+            except OperationalError:
+                db.rollback()
+                deadlocks += 1
+            finally:
+                db.close()
+
+        before = lock_status()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(THREADS) as pool:
+            list(pool.map(purchase, carts))
+        elapsed = time.perf_counter() - start
+        after = lock_status()
+        waits.sort()
+        p99 = waits[int(len(waits) * 0.99) - 1] if waits else 0
+        print(f"[{label}] {elapsed:.2f}s, デッドロック等 {deadlocks}件, "
+              f"ロック待ち {after['Innodb_row_lock_waits'] - before['Innodb_row_lock_waits']}回 / "
+              f"{after['Innodb_row_lock_time'] - before['Innodb_row_lock_time']}ms, "
+              f"減算p99 {p99 * 1000:.1f}ms")
+
+    try:
+        run("明細ごとUPDATE", naive)
+        run("集約・整列UPDATE", aggregated)
+    finally:
+        with Session() as db:
+            db.query(InventoryData).filter(InventoryData.store_code == STORE).delete()
+            db.commit()
@@ -1,6 +1,6 @@
-from sqlalchemy import String, Integer, ForeignKey, DateTime, Numeric, Text
-from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
-from datetime import datetime
+from sqlalchemy import String, Integer, ForeignKey, DateTime, Numeric, Text, Time, Index, event, inspect, insert, select, update
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, Session
+from datetime import datetime, time
 
 class Base(DeclarativeBase):
     pass
@@ -53,6 +53,11 @@ class TransactionData(Base):
     total_amount_incl_tax: Mapped[int] = mapped_column(Integer, nullable=False, comment="合計金額（税込）")
     remarks: Mapped[str] = mapped_column(Text, nullable=True, comment="備考")
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.now, comment="作成日時")
+    
+    __table_args__ = (
+        Index("ix_transaction_data_store_datetime", "store_code", "transaction_datetime"),
+        Index("ix_transaction_data_pos_datetime", "pos_machine_id", "transaction_datetime"),
+    )
 
 # 取引明細データ
 class TransactionDetail(Base):
@@ -69,4 +74,141 @@ class TransactionDetail(Base):
     tax_rate: Mapped[float] = mapped_column(Numeric(5, 4), nullable=False, comment="税率（取引時点）")
     tax_amount: Mapped[int] = mapped_column(Integer, nullable=False, comment="消費税額")
     subtotal_incl_tax: Mapped[int] = mapped_column(Integer, nullable=False, comment="小計（税込）")
-    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.now, comment="作成日時")
\ No newline at end of file
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.now, comment="作成日時")
+
+# プロモーションマスタ
+class PromotionMaster(Base):
+    __tablename__ = 'promotion_master'
+    
+    promotion_id: Mapped[str] = mapped_column(String(20), primary_key=True, comment="プロモーションID")
+    promotion_name: Mapped[str] = mapped_column(String(100), nullable=False, comment="プロモーション名")
+    promotion_type: Mapped[str] = mapped_column(String(20), nullable=False, comment="種別(MULTI_BUY:まとめ買い, BUNDLE:セット, TIME_DISCOUNT:時間帯値引)")
+    required_quantity: Mapped[int] = mapped_column(Integer, nullable=True, comment="まとめ買い必要数量（MULTI_BUY用）")
+    promo_price: Mapped[int] = mapped_column(Integer, nullable=True, comment="セット価格（税抜・MULTI_BUY/BUNDLE用）")
+    discount_rate: Mapped[float] = mapped_column(Numeric(5, 4), nullable=True, comment="値引率（TIME_DISCOUNT用 例: 0.2000）")
+    discount_amount: Mapped[int] = mapped_column(Integer, nullable=True, comment="1点あたり値引額（税抜・TIME_DISCOUNT用）")
+    start_datetime: Mapped[datetime] = mapped_column(DateTime, nullable=False, comment="適用開始日時")
+    end_datetime: Mapped[datetime] = mapped_column(DateTime, nullable=True, comment="適用終了日時（NULLは無期限）")
+    daily_start_time: Mapped[time] = mapped_column(Time, nullable=True, comment="適用開始時刻（毎日）")
+    daily_end_time: Mapped[time] = mapped_column(Time, nullable=True, comment="適用終了時刻（毎日）")
+    priority: Mapped[int] = mapped_column(Integer, default=100, comment="適用優先度（小さいほど先に適用）")
+    is_active: Mapped[bool] = mapped_column(Integer, default=1, comment="有効フラグ(0:無効, 1:有効)")
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.now, comment="作成日時")
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.now, onupdate=datetime.now, comment="更新日時")
+
+# プロモーション対象商品
+class PromotionItem(Base):
+    __tablename__ = 'promotion_item'
+    
+    promotion_id: Mapped[str] = mapped_column(String(20), ForeignKey("promotion_master.promotion_id"), primary_key=True, comment="プロモーションID")
+    barcode: Mapped[str] = mapped_column(String(20), ForeignKey("product_master.barcode"), primary_key=True, comment="バーコード")
+    quantity: Mapped[int] = mapped_column(Integer, default=1, comment="セット構成数量（BUNDLE用）")
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.now, comment="作成日時")
+
+# 取引プロモーション適用データ
+class TransactionPromotion(Base):
+    __tablename__ = 'transaction_promotion'
+    
+    transaction_id: Mapped[str] = mapped_column(String(30), ForeignKey("transaction_data.transaction_id"), primary_key=True, comment="取引ID")
+    promotion_id: Mapped[str] = mapped_column(String(20), ForeignKey("promotion_master.promotion_id"), primary_key=True, comment="プロモーションID")
+    promotion_name: Mapped[str] = mapped_column(String(100), nullable=False, comment="プロモーション名（取引時点）")
+    applied_count: Mapped[int] = mapped_column(Integer, nullable=False, comment="適用回数")
+    discount_amount: Mapped[int] = mapped_column(Integer, nullable=False, comment="値引額（税抜）")
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.now, comment="作成日時")
+
+# 在庫データ
+class InventoryData(Base):
+    __tablename__ = 'inventory_data'
+    
+    store_code: Mapped[str] = mapped_column(String(10), primary_key=True, comment="店舗コード")
+    barcode: Mapped[str] = mapped_column(String(20), ForeignKey("product_master.barcode"), primary_key=True, comment="バーコード")
+    quantity: Mapped[int] = mapped_column(Integer, nullable=False, default=0, comment="在庫数量")
+    reorder_point: Mapped[int] = mapped_column(Integer, nullable=False, default=0, comment="発注点（この数量以下で在庫僅少）")
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.now, onupdate=datetime.now, comment="更新日時")
+
+# 在庫減算待ち（バッチ反映モードで購入トランザクション内に記録し、バッチャーが反映後に削除）
+class InventoryPendingDecrement(Base):
+    __tablename__ = 'inventory_pending_decrement'
+
+    pending_id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True, comment="減算待ちID")
+    store_code: Mapped[str] = mapped_column(String(10), nullable=False, comment="店舗コード")
+    barcode: Mapped[str] = mapped_column(String(20), nullable=False, comment="バーコード")
+    quantity: Mapped[int] = mapped_column(Integer, nullable=False, comment="減算数量")
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.now, comment="作成日時")
+
+# 価格変更バージョン採番（1行のみ、行ロックによりコミット順に採番する）
+class PriceChangeVersion(Base):
+    __tablename__ = 'price_change_version'
+    
+    counter_id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False, comment="カウンターID（常に1）")
+    version: Mapped[int] = mapped_column(Integer, nullable=False, default=0, comment="最後に採番したバージョン")
+
+# 価格変更履歴（端末への価格変更通知用）
+class PriceChangeLog(Base):
+    __tablename__ = 'price_change_log'
+    
+    version: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False, comment="変更バージョン（端末の再接続カーソル、price_change_version で採番）")
+    change_type: Mapped[str] = mapped_column(String(10), nullable=False, comment="変更種別(product:商品, tax:税)")
+    barcode: Mapped[str] = mapped_column(String(20), nullable=True, comment="バーコード（product用）")
+    product_name: Mapped[str] = mapped_column(String(200), nullable=True, comment="商品名（product用、商品名検索インデックスの更新に使用）")
+    unit_price: Mapped[int] = mapped_column(Integer, nullable=True, comment="単価（税抜・product用）")
+    tax_code: Mapped[str] = mapped_column(String(10), nullable=True, comment="税区分コード")
+    tax_rate: Mapped[float] = mapped_column(Numeric(5, 4), nullable=True, comment="税率（tax用）")
+    is_active: Mapped[bool] = mapped_column(Integer, nullable=False, comment="有効フラグ(0:無効, 1:有効)")
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.now, comment="作成日時")
+
+
+# 商品・税マスタの変更を price_change_log へ記録（価格変更通知用）
+# モデル定義と同じモジュールで登録し、APIサーバー以外（初期データ投入・管理スクリプト等）の ORM 経由の更新も記録する
+_PRODUCT_FIELDS = ("product_name", "unit_price", "tax_code", "is_active")
+_TAX_FIELDS = ("tax_rate", "is_active")
+
+
+def _changed(obj, fields) -> bool:
+    attrs = inspect(obj).attrs
+    return any(attrs[field].history.has_changes() for field in fields)
+
+
+@event.listens_for(Session, "before_flush")
+def _record_price_changes(session, flush_context, instances):
+    """
+    商品・税マスタの変更を履歴として同じフラッシュで登録
+    """
+    logs = []
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, ProductMaster):
+            if obj in session.new or _changed(obj, _PRODUCT_FIELDS):
+                logs.append(PriceChangeLog(
+                    change_type="product", barcode=obj.barcode, product_name=obj.product_name, unit_price=obj.unit_price,
+                    tax_code=obj.tax_code, is_active=1 if obj.is_active is None else obj.is_active
+                ))
+        elif isinstance(obj, TaxMaster):
+            if obj in session.new or _changed(obj, _TAX_FIELDS):
+                logs.append(PriceChangeLog(
+                    change_type="tax", tax_code=obj.tax_code, tax_rate=obj.tax_rate,
+                    is_active=1 if obj.is_active is None else obj.is_active
+                ))
+    for obj in session.deleted:
+        if isinstance(obj, ProductMaster):
+            logs.append(PriceChangeLog(change_type="product", barcode=obj.barcode, tax_code=obj.tax_code, is_active=0))
+        elif isinstance(obj, TaxMaster):
+            logs.append(PriceChangeLog(change_type="tax", tax_code=obj.tax_code, is_active=0))
+    if not logs:
+        return
+
+    # バージョンは1行カウンターを行ロックして採番する。ロックはコミットまで保持されるため、
+    # 小さいバージョンほど先にコミットされ、ポーリング側が「version > 最終配信」で取りこぼさない
+    # （AUTO_INCREMENT はINSERT時に採番されコミット順と一致しないため使わない）
+    conn = session.connection()
+    current = conn.execute(
+        select(PriceChangeVersion.__table__.c.version).where(PriceChangeVersion.__table__.c.counter_id == 1).with_for_update()
+    ).scalar()
+    if current is None:
+        current = 0
+        conn.execute(insert(PriceChangeVersion.__table__).values(counter_id=1, version=0))
+    conn.execute(
+        update(PriceChangeVersion.__table__).where(PriceChangeVersion.__table__.c.counter_id == 1).values(version=current + len(logs))
+    )
+    for offset, log in enumerate(logs, 1):
+        log.version = current + offset
+    session.add_all(logs)
@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+"""
+取引データの月次パーティション管理とアーカイブ
+
+transaction_data / transaction_detail を取引日で RANGE COLUMNS パーティション化する。
+取引ID・明細IDは先頭が取引日（YYYYMMDD）のため、主キーをそのまま分割キーに使える
+（MySQLの制約「全ての一意キーに分割キーを含む」を主キー変更なしで満たす）。
+
+注意: MySQL(InnoDB)のパーティション表は外部キーを持てない・参照されないため、
+パーティション化時に取引テーブル関連の外部キーを削除する（整合性は購入処理のトランザクションで担保）。
+
+使い方:
+    python -m db_control.partitioning enable              # パーティション化（初回のみ）
+    python -m db_control.partitioning maintain            # 先の月のパーティションを追加
+    python -m db_control.partitioning archive [--to-file] # 保持期間を過ぎた月をアーカイブ
+    python -m db_control.partitioning benchmark [行数]    # パーティション・索引の有無で比較
+"""
+
+import csv
+import gzip
+import os
+import sys
+import time
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from sqlalchemy import text
+
+from db_control.mymodels_MySQL import TransactionData
+
+# アーカイブは明細→ヘッダーの順に処理する
+PARTITIONED_TABLES = ("transaction_detail", "transaction_data")
+# 取引IDで紐づく非パーティション表（アーカイブ時に一緒に移す）
+TRANSACTION_CHILD_TABLES = ("transaction_promotion",)
+
+# 何か月先までパーティションを用意しておくか
+MONTHS_AHEAD = int(os.getenv("TRANSACTION_PARTITION_MONTHS_AHEAD", "3"))
+# 何か月分を取引テーブルに残すか（それより古い月はアーカイブ）
+RETENTION_MONTHS = int(os.getenv("TRANSACTION_RETENTION_MONTHS", "24"))
+# ファイルアーカイブの出力先
+ARCHIVE_DIR = os.getenv("TRANSACTION_ARCHIVE_DIR", str(Path(__file__).resolve().parent.parent / "archive"))
+
+
+def is_partitioning_enabled() -> bool:
+    """
+    環境変数 TRANSACTION_PARTITIONING=1 でパーティション化を有効にする
+    """
+    return os.getenv("TRANSACTION_PARTITIONING", "0").lower() in ("1", "true", "yes")
+
+
+def _add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def _month_partition(month: date) -> str:
+    upper = _add_months(month, 1)
+    return f"PARTITION p{month:%Y%m} VALUES LESS THAN ('{upper:%Y%m%d}')"
+
+
+def _partition_key(table: str) -> str:
+    return "detail_id" if table == "transaction_detail" else "transaction_id"
+
+
+def current_transaction_datetime() -> datetime:
+    """
+    取引日時（秒単位）
+    DATETIME 列は小数秒を持たず挿入時に四捨五入されるため、先に切り捨てておく
+    （23:59:59.6 が翌日 00:00:00 で保存され、取引IDの日付と食い違うのを防ぐ）
+    """
+    return datetime.now().replace(microsecond=0)
+
+
+def generate_transaction_id(store_code: str, pos_machine_id: str, now: datetime) -> str:
+    """
+    取引ID生成（取引日時と同じ now から生成し、日付プレフィックスと取引日時を一致させる）
+    """
+    date_str = now.strftime("%Y%m%d")
+    time_str = now.strftime("%H%M%S")
+    return f"{date_str}_{store_code}_{pos_machine_id}_{time_str}"
+
+
+def transaction_id_bounds(
+    start: Optional[datetime] = None, end: Optional[datetime] = None
+) -> Tuple[Optional[str], Optional[str]]:
+    """
+    取引日時 start 以上 end 未満の取引を含む取引IDの範囲 (下限以上, 上限未満)
+    取引IDは取引日（YYYYMMDD）始まりのため、日付境界に丸めた文字列で表せる
+    """
+    lower = f"{start:%Y%m%d}" if start is not None else None
+    upper = None
+    if end is not None:
+        last_day = (end - timedelta(microseconds=1)).date()
+        upper = f"{last_day + timedelta(days=1):%Y%m%d}"
+    return lower, upper
+
+
+def transaction_id_range(start: Optional[datetime] = None, end: Optional[datetime] = None) -> list:
+    """
+    取引日時の範囲に対応する取引IDの範囲条件
+    取引日時だけの条件ではパーティションが絞り込まれないため、取引日時で期間指定する照会は必ず併用する
+    """
+    lower, upper = transaction_id_bounds(start, end)
+    conditions = []
+    if lower is not None:
+        conditions.append(TransactionData.transaction_id >= lower)
+    if upper is not None:
+        conditions.append(TransactionData.transaction_id < upper)
+    return conditions
+
+
+def transaction_datetime_range(start: Optional[datetime] = None, end: Optional[datetime] = None) -> list:
+    """
+    取引日時 start 以上 end 未満の条件（パーティション絞り込み用の取引ID範囲条件付き）
+    例: db.query(TransactionData).filter(TransactionData.store_code == s, *transaction_datetime_range(start, end))
+    """
+    conditions = []
+    if start is not None:
+        conditions.append(TransactionData.transaction_datetime >= start)
+    if end is not None:
+        conditions.append(TransactionData.transaction_datetime < end)
+    return conditions + transaction_id_range(start, end)
+
+
+def list_partitions(conn, table: str) -> List[Tuple[str, str]]:
+    """
+    (パーティション名, 上限値) の一覧（上限値の昇順、MAXVALUEは除く）
+    """
+    rows = conn.execute(text(
+        "SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table AND PARTITION_NAME IS NOT NULL "
+        "ORDER BY PARTITION_ORDINAL_POSITION"
+    ), {"table": table}).all()
+    return [(name, desc.strip("'")) for name, desc in rows if desc != "MAXVALUE"]
+
+
+def is_partitioned(conn, table: str) -> bool:
+    return conn.execute(text(
+        "SELECT COUNT(*) FROM information_schema.PARTITIONS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table AND PARTITION_NAME IS NOT NULL"
+    ), {"table": table}).scalar() > 0
+
+
+def drop_transaction_foreign_keys(conn):
+    """
+    取引テーブルが持つ・参照される外部キーを削除（パーティション化の前提条件）
+    """
+    rows = conn.execute(text(
+        "SELECT DISTINCT TABLE_NAME, CONSTRAINT_NAME FROM information_schema.KEY_COLUMN_USAGE "
+        "WHERE TABLE_SCHEMA = DATABASE() AND REFERENCED_TABLE_NAME IS NOT NULL "
+        "AND (TABLE_NAME IN (:data, :detail) OR REFERENCED_TABLE_NAME IN (:data, :detail))"
+    ), {"data": "transaction_data", "detail": "transaction_detail"}).all()
+    for table, constraint in rows:
+        print(f"外部キー削除: {table}.{constraint}")
+        conn.execute(text(f"ALTER TABLE `{table}` DROP FOREIGN KEY `{constraint}`"))
+
+
+def enable_partitioning(conn, today: date = None):
+    """
+    取引テーブルを月次パーティション化（既にパーティション化済みの表はスキップ）
+    最古の取引月から MONTHS_AHEAD か月先まで作成し、それより古い分は p_before、先は pmax に入る
+    """
+    today = today or date.today()
+    current = today.replace(day=1)
+
+    oldest = conn.execute(text("SELECT MIN(transaction_id) FROM transaction_data")).scalar()
+    first = current
+    if oldest and oldest[:6].isdigit():
+        first = min(first, date(int(oldest[:4]), int(oldest[4:6]), 1))
+
+    months = []
+    month = first
+    while month <= _add_months(current, MONTHS_AHEAD):
+        months.append(month)
+        month = _add_months(month, 1)
+
+    partitions = ",\n".join(
+        [f"PARTITION p_before VALUES LESS THAN ('{first:%Y%m%d}')"]
+        + [_month_partition(m) for m in months]
+        + ["PARTITION pmax VALUES LESS THAN (MAXVALUE)"]
+    )
+
+    drop_transaction_foreign_keys(conn)
+    for table in PARTITIONED_TABLES:
+        if is_partitioned(conn, table):
+            print(f"パーティション化済み: {table}")
+            continue
+        print(f"パーティション化: {table}（{len(months)}か月分）")
+        conn.execute(text(
+            f"ALTER TABLE `{table}` PARTITION BY RANGE COLUMNS(`{_partition_key(table)}`) (\n{partitions}\n)"
+        ))
+
+
+def ensure_future_partitions(conn, today: date = None):
+    """
+    pmax を分割して MONTHS_AHEAD か月先までの月次パーティションを追加
+    """
+    today = today or date.today()
+    target = _add_months(today.replace(day=1), MONTHS_AHEAD)
+    for table in PARTITIONED_TABLES:
+        if not is_partitioned(conn, table):
+            continue
+        existing = list_partitions(conn, table)
+        last_upper = existing[-1][1] if existing else f"{today.replace(day=1):%Y%m%d}"
+        month = date(int(last_upper[:4]), int(last_upper[4:6]), 1)
+        new_partitions = []
+        while month <= target:
+            new_partitions.append(_month_partition(month))
+            month = _add_months(month, 1)
+        if not new_partitions:
+            continue
+        print(f"パーティション追加: {table} {len(new_partitions)}件")
+        conn.execute(text(
+            f"ALTER TABLE `{table}` REORGANIZE PARTITION pmax INTO (\n"
+            + ",\n".join(new_partitions + ["PARTITION pmax VALUES LESS THAN (MAXVALUE)"])
+            + "\n)"
+        ))
+
+
+def ensure_transaction_indexes(conn):
+    """
+    既存DBに取引データの複合インデックスが無ければ追加（create_all は既存テーブルに索引を追加しないため）
+    """
+    existing = {
+        name for (name,) in conn.execute(text(
+            "SELECT DISTINCT INDEX_NAME FROM information_schema.STATISTICS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'transaction_data'"
+        )).all()
+    }
+    for index in TransactionData.__table__.indexes:
+        if index.name not in existing:
+            print(f"インデックス作成: {index.name}")
+            index.create(bind=conn)
+
+
+def _ensure_archive_table(conn, table: str):
+    archive = f"{table}_archive"
+    exists = conn.execute(text(
+        "SELECT COUNT(*) FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :t"
+    ), {"t": archive}).scalar()
+    if exists:
+        return archive
+    print(f"アーカイブテーブル作成: {archive}")
+    conn.execute(text(f"CREATE TABLE `{archive}` LIKE `{table}`"))
+    if is_partitioned(conn, table):
+        conn.execute(text(f"ALTER TABLE `{archive}` REMOVE PARTITIONING"))
+    conn.execute(text(f"ALTER TABLE `{archive}` ROW_FORMAT=COMPRESSED"))
+    return archive
+
+
+def _write_csv_gz(conn, sql: str, params: dict, path: Path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    result = conn.execution_options(stream_results=True).execute(text(sql), params)
+    count = 0
+    with gzip.open(path, "wt", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(result.keys())
+        for rows in result.partitions(10000):
+            writer.writerows(rows)
+            count += len(rows)
+    print(f"ファイル出力: {path}（{count}件）")
+
+
+def archive_old_partitions(conn, to_file: bool = False, today: date = None):
+    """
+    保持期間（RETENTION_MONTHS）より古いパーティションをアーカイブしてから削除
+    - 既定: 圧縮行形式の <table>_archive テーブルへ移動
+    - to_file=True: ARCHIVE_DIR に gzip圧縮CSVで出力
+    途中で失敗しても再実行できるよう、移動は INSERT IGNORE で冪等にしている
+    """
+    today = today or date.today()
+    cutoff = f"{_add_months(today.replace(day=1), -RETENTION_MONTHS):%Y%m%d}"
+
+    for name, upper in list_partitions(conn, "transaction_data"):
+        if upper > cutoff:
+            break
+        print(f"アーカイブ: {name}（{upper} より前）")
+        lower = conn.execute(text(
+            "SELECT MIN(transaction_id) FROM transaction_data PARTITION (" + name + ")"
+        )).scalar()
+
+        if lower is not None:
+            for child in TRANSACTION_CHILD_TABLES:
+                where = f"FROM `{child}` WHERE transaction_id >= :lower AND transaction_id < :upper"
+                params = {"lower": lower, "upper": upper}
+                if to_file:
+                    _write_csv_gz(conn, f"SELECT * {where}", params, Path(ARCHIVE_DIR) / f"{child}_{name}.csv.gz")
+                else:
+                    archive = _ensure_archive_table(conn, child)
+                    conn.execute(text(f"INSERT IGNORE INTO `{archive}` SELECT * {where}"), params)
+                conn.execute(text(f"DELETE {where}"), params)
+                conn.commit()
+
+        for table in PARTITIONED_TABLES:
+            if to_file:
+                _write_csv_gz(
+                    conn, f"SELECT * FROM `{table}` PARTITION ({name})", {},
+                    Path(ARCHIVE_DIR) / f"{table}_{name}.csv.gz"
+                )
+            else:
+                archive = _ensure_archive_table(conn, table)
+                conn.execute(text(f"INSERT IGNORE INTO `{archive}` SELECT * FROM `{table}` PARTITION ({name})"))
+                conn.commit()
+
+        # パーティション削除は瞬時（DELETEによる大量の行削除・索引更新を伴わない）
+        for table in PARTITIONED_TABLES:
+            conn.execute(text(f"ALTER TABLE `{table}` DROP PARTITION {name}"))
+
+
+def run_benchmark(conn, rows: int):
+    """
+    複合インデックスとパーティションの効果を分けて、代表的な照会を比較
+    - bench_tx_plain: 主キーのみ
+    - bench_tx_indexed: 主キー＋複合インデックス
+    - bench_tx_part: 主キー＋複合インデックス＋月次パーティション（取引ID範囲条件なし/あり）
+    終了時にベンチマーク用テーブルを削除する
+    """
+    today = date.today().replace(day=1)
+    first = _add_months(today, -23)
+    months = [_add_months(first, i) for i in range(24)]
+    partitions = ",\n".join(
+        [f"PARTITION p_before VALUES LESS THAN ('{first:%Y%m%d}')"]
+        + [_month_partition(m) for m in months]
+        + ["PARTITION pmax VALUES LESS THAN (MAXVALUE)"]
+    )
+    columns = (
+        "transaction_id VARCHAR(30) NOT NULL PRIMARY KEY, store_code VARCHAR(10) NOT NULL, "
+        "pos_machine_id VARCHAR(10) NOT NULL, transaction_datetime DATETIME NOT NULL, "
+        "total_amount_incl_tax INT NOT NULL"
+    )
+    indexes = (
+        "INDEX ix_store_datetime (store_code, transaction_datetime), "
+        "INDEX ix_pos_datetime (pos_machine_id, transaction_datetime)"
+    )
+    tables = ("bench_tx_plain", "bench_tx_indexed", "bench_tx_part")
+    conn.execute(text(f"DROP TABLE IF EXISTS {', '.join(tables)}"))
+    conn.execute(text(f"CREATE TABLE bench_tx_plain ({columns})"))
+    conn.execute(text(f"CREATE TABLE bench_tx_indexed ({columns}, {indexes})"))
+    conn.execute(text(
+        f"CREATE TABLE bench_tx_part ({columns}, {indexes}) "
+        f"PARTITION BY RANGE COLUMNS(transaction_id) (\n{partitions}\n)"
+    ))
+
+    try:
+        # 24か月に分散した取引を生成（店舗50・POS機500）
+        print(f"ベンチマーク用データ生成: {rows}件")
+        conn.execute(text("SET SESSION cte_max_recursion_depth = :n"), {"n": rows + 1})
+        conn.execute(text(
+            "INSERT INTO bench_tx_plain "
+            "WITH RECURSIVE seq (n) AS (SELECT 0 UNION ALL SELECT n + 1 FROM seq WHERE n < :last) "
+            "SELECT CONCAT(DATE_FORMAT(dt, '%Y%m%d'), '_', LPAD(n, 12, '0')), "
+            "CONCAT('S', n % 50), CONCAT('P', n % 500), dt, n % 10000 "
+            "FROM (SELECT n, :first + INTERVAL (n * 727) % (730 * 86400) SECOND AS dt FROM seq) s"
+        ), {"last": rows - 1, "first": first})
+        conn.execute(text("INSERT INTO bench_tx_indexed SELECT * FROM bench_tx_plain"))
+        conn.execute(text("INSERT INTO bench_tx_part SELECT * FROM bench_tx_plain"))
+        conn.commit()
+
+        month_start = datetime.combine(_add_months(today, -1), datetime.min.time())
+        month_end = datetime.combine(today, datetime.min.time())
+        lower, upper = transaction_id_bounds(month_start, month_end)
+        queries = {
+            "店舗×1か月の売上合計": (
+                "SELECT COUNT(*), SUM(total_amount_incl_tax) FROM {t} "
+                "WHERE store_code = 'S7' AND transaction_datetime >= :start AND transaction_datetime < :end"
+                "{prune}"
+            ),
+            "POS機の直近20件": (
+                "SELECT transaction_id FROM {t} WHERE pos_machine_id = 'P42' "
+                "ORDER BY transaction_datetime DESC, transaction_id DESC LIMIT 20"
+            ),
+        }
+        params = {"start": month_start, "end": month_end, "lower": lower, "upper": upper}
+        prune = " AND transaction_id >= :lower AND transaction_id < :upper"
+        cases = (
+            ("主キーのみ", "bench_tx_plain", False),
+            ("複合インデックス", "bench_tx_indexed", False),
+            ("インデックス＋パーティション", "bench_tx_part", False),
+            ("インデックス＋パーティション＋取引ID範囲", "bench_tx_part", True),
+        )
+        for label, sql in queries.items():
+            for case, table, use_prune in cases:
+                if use_prune and "{prune}" not in sql:
+                    continue
+                statement = sql.format(t=table, prune=prune if use_prune else "")
+                plan = conn.execute(text(f"EXPLAIN {statement}"), params).mappings().first()
+                start = time.perf_counter()
+                conn.execute(text(statement), params).all()
+                elapsed = time.perf_counter() - start
+                print(f"[{label}] {case}: {elapsed * 1000:.1f}ms "
+                      f"(key={plan.get('key')}, partitions={plan.get('partitions')})")
+    finally:
+        conn.execute(text(f"DROP TABLE IF EXISTS {', '.join(tables)}"))
+
+
+if __name__ == "__main__":
+    from db_control.connect_MySQL import engine
+
+    engine.echo = False
+    command = sys.argv[1] if len(sys.argv) > 1 else "maintain"
+    with engine.connect() as conn:
+        if command == "enable":
+            ensure_transaction_indexes(conn)
+            enable_partitioning(conn)
+        elif command == "maintain":
+            ensure_future_partitions(conn)
+        elif command == "archive":
+            archive_old_partitions(conn, to_file="--to-file" in sys.argv)
+            ensure_future_partitions(conn)
+        elif command == "benchmark":
+            run_benchmark(conn, int(sys.argv[2]) if len(sys.argv) > 2 else 10_000_000)
+        else:
+            print(__doc__)
+            sys.exit(1)
+        conn.commit()
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+価格変更通知（Server-Sent Events）
+
+商品マスタ・税マスタの変更は mymodels_MySQL のフラッシュ時イベントで price_change_log に同一トランザクションで記録され
+（バージョンはコミット順に採番、モデルを使う全てのプロセスで有効）、
+各ワーカーの配信タスクが1本のポーリングで新しい変更を取り込んで接続中の端末へ配信する。
+
+- 端末ごとのキューは持たず、共有のリングバッファを各接続がカーソル（version）で読む
+  → 接続数が増えてもメモリは「接続ごとのカーソル + 固定長バッファ」で済む
+- 再接続時は Last-Event-ID（または since）から再開し、バッファ外なら履歴テーブルから補完、
+  それでも追いつけない場合や、カーソルが最新バージョンより先の場合は reset イベントで全件再取得を促す
+"""
+
+import asyncio
+import json
+from collections import deque
+from typing import List, Optional, Tuple
+
+from sqlalchemy import func
+
+from db_control.mymodels_MySQL import PriceChangeLog
+
+# リングバッファに保持する変更件数
+BUFFER_SIZE = 10000
+# 履歴テーブルのポーリング間隔（秒）
+POLL_INTERVAL_SECONDS = 1.0
+# アイドル接続の切断を防ぐキープアライブ間隔（秒）
+HEARTBEAT_SECONDS = 15.0
+
+def _to_event(log: PriceChangeLog) -> Tuple[int, str]:
+    """
+    履歴1件を (version, SSEメッセージ) に変換（値がNoneの項目は省略）
+    """
+    payload = {
+        "v": log.version,
+        "type": log.change_type,
+        "barcode": log.barcode,
+        "unit_price": log.unit_price,
+        "tax_code": log.tax_code,
+        "tax_rate": float(log.tax_rate) if log.tax_rate is not None else None,
+        "is_active": log.is_active,
+    }
+    data = json.dumps({k: v for k, v in payload.items() if v is not None}, ensure_ascii=False, separators=(",", ":"))
+    return log.version, f"id: {log.version}\nevent: price\ndata: {data}\n\n"
+
+
+def _fetch_after(session_factory, version: int, limit: int) -> List[Tuple[int, str]]:
+    db = session_factory()
+    try:
+        logs = db.query(PriceChangeLog).filter(
+            PriceChangeLog.version > version
+        ).order_by(PriceChangeLog.version).limit(limit).all()
+        return [_to_event(log) for log in logs]
+    finally:
+        db.close()
+
+
+def _fetch_latest_version(session_factory) -> int:
+    db = session_factory()
+    try:
+        return db.query(func.max(PriceChangeLog.version)).scalar() or 0
+    finally:
+        db.close()
+
+
+class PriceEventBroadcaster:
+    """
+    ワーカー内の価格変更配信ハブ
+    """
+
+    def __init__(self, session_factory):
+        self._session_factory = session_factory
+        self._buffer = deque(maxlen=BUFFER_SIZE)  # (version, message)
+        self._changed = asyncio.Event()
+        self._task = None
+        self.version = None  # 最終配信バージョン（DBから初期化するまではNone）
+        self.connections = 0
+
+    async def start(self):
+        """
+        ポーリング開始（DB未接続・テーブル未作成でも起動を妨げないよう、初期化はポーリング側で行う）
+        """
+        self._task = asyncio.create_task(self._poll())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _poll(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                if self.version is None:
+                    self.version = await loop.run_in_executor(
+                        None, _fetch_latest_version, self._session_factory
+                    )
+                    self._notify()
+                events = await loop.run_in_executor(
+                    None, _fetch_after, self._session_factory, self.version, BUFFER_SIZE
+                )
+                if events:
+                    self.publish(events)
+            except Exception as e:
+                print(f"価格変更ポーリングエラー: {str(e)}")
+            await asyncio.sleep(POLL_INTERVAL_SECONDS)
+
+    def publish(self, events):
+        self._buffer.extend(events)
+        self.version = events[-1][0]
+        self._notify()
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def _wait_for_change(self) -> bool:
+        """
+        変更通知を待つ（キープアライブ間隔を過ぎたらFalse）
+        """
+        try:
+            await asyncio.wait_for(self._changed.wait(), HEARTBEAT_SECONDS)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def _events_after(self, cursor: int) -> Optional[list]:
+        """
+        バッファからcursorより新しい変更を取得（バッファ外の場合はNone）
+        """
+        if cursor >= self.version:
+            return []
+        if not self._buffer or self._buffer[0][0] > cursor + 1:
+            return None
+        events = []
+        for item in reversed(self._buffer):
+            if item[0] <= cursor:
+                break
+            events.append(item)
+        events.reverse()
+        return events
+
+    async def stream(self, cursor: Optional[int], is_disconnected):
+        """
+        1接続分のSSEメッセージを生成
+        """
+        loop = asyncio.get_running_loop()
+        self.connections += 1
+        try:
+            # 配信バージョンが初期化されるまで待機
+            while self.version is None:
+                if await is_disconnected():
+                    return
+                if not await self._wait_for_change():
+                    yield ": keepalive\n\n"
+            if cursor is None:
+                cursor = self.version
+            yield f"retry: 3000\nevent: hello\ndata: {json.dumps({'v': cursor})}\n\n"
+
+            while not await is_disconnected():
+                if cursor > self.version:
+                    # サーバーより先のカーソル（不正な since・DB復元前に保存されたカーソル等）は、
+                    # このワーカーのポーリング遅れでなければ全件再取得を促す（そのままでは間の変更を取りこぼす）
+                    latest = await loop.run_in_executor(None, _fetch_latest_version, self._session_factory)
+                    if cursor > latest:
+                        cursor = self.version
+                        yield f"id: {cursor}\nevent: reset\ndata: {json.dumps({'v': cursor})}\n\n"
+                        continue
+                    if not await self._wait_for_change():
+                        yield ": keepalive\n\n"
+                    continue
+                events = self._events_after(cursor)
+                if events is None:
+                    # バッファ外のカーソルは履歴テーブルから補完
+                    events = await loop.run_in_executor(
+                        None, _fetch_after, self._session_factory, cursor, BUFFER_SIZE
+                    )
+                    if len(events) >= BUFFER_SIZE:
+                        # 追いつけないほど古いカーソルは全件再取得を促す
+                        cursor = self.version
+                        yield f"id: {cursor}\nevent: reset\ndata: {json.dumps({'v': cursor})}\n\n"
+                        continue
+                for version, message in events:
+                    yield message
+                    cursor = version
+
+                if cursor >= self.version and not await self._wait_for_change():
+                    yield ": keepalive\n\n"
+        finally:
+            self.connections -= 1
@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+"""
+商品名検索用のインメモリN-gramインデックス
+
+バーコードの無い商品（量り売り・ラベル破損など）を商品名で検索するため、
+ProductMaster.product_name を正規化した文字列の2-gram転置インデックスを保持する。
+SQLの LIKE '%…%' による全件走査を避け、候補を最小のポスティングに絞ってから
+部分文字列で確定させる。
+1文字のクエリは候補が膨大になるため前方一致のみとし、先頭文字の索引で引く。
+
+商品マスタの変更は price_change_log（全ワーカー共通の変更履歴）をバージョン順に取り込んで反映する。
+同じプロセス内のORMコミットはコミット時にも即時反映する。
+"""
+
+import heapq
+import threading
+import time
+import unicodedata
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session
+
+from db_control.mymodels_MySQL import ProductMaster, PriceChangeLog
+
+NGRAM_SIZE = 2
+# 変更履歴を確認する最短間隔（秒）
+REFRESH_INTERVAL_SECONDS = 2.0
+# 1回の確認で取り込む変更履歴の最大件数
+REFRESH_LIMIT = 1000
+
+# カタカナ（ァ〜ヶ）をひらがなへ寄せる変換表
+_KATAKANA_TO_HIRAGANA = {code: code - 0x60 for code in range(0x30A1, 0x30F7)}
+
+
+def normalize_name(text: str) -> str:
+    """
+    検索用の文字列正規化
+    全角/半角の統一（NFKC）、大文字小文字の統一、カタカナ→ひらがな、空白除去
+    """
+    text = unicodedata.normalize("NFKC", text or "").casefold()
+    text = text.translate(_KATAKANA_TO_HIRAGANA)
+    return "".join(text.split())
+
+
+def _ngrams(text: str):
+    return {text[i:i + NGRAM_SIZE] for i in range(len(text) - NGRAM_SIZE + 1)}
+
+
+class ProductSearchIndex:
+    """
+    商品名のN-gram転置インデックス
+
+    - ポスティングは文書ID昇順の array('i') で保持（1M件でもメモリを抑える）
+    - 更新・削除は旧文書IDを無効化して新IDを振る（追記のみ）
+    - 無効化された文書が有効件数を上回ったら再構築する
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self.loaded = False
+        self._loading = False
+        self._backlog: List[Dict[str, Optional[Tuple[str, int]]]] = []  # 構築中にコミットされた変更
+        self._refresh_lock = threading.Lock()
+        self._refreshed_at = 0.0
+        self.version = None  # 取り込み済みの変更履歴バージョン（履歴を読めない場合はNone）
+        self._reset()
+
+    def _reset(self):
+        self._names: List[Optional[str]] = []      # 文書ID -> 正規化済み商品名（削除済みはNone）
+        self._barcodes: List[Optional[str]] = []   # 文書ID -> バーコード
+        self._doc_ids: Dict[str, int] = {}         # バーコード -> 文書ID
+        self._postings: Dict[str, array] = {}      # N-gram -> 文書IDの配列
+        self._prefixes: Dict[str, array] = {}      # 先頭文字 -> 文書IDの配列（1文字クエリ用）
+        self._dead = 0
+
+    def load(self, db):
+        """
+        有効な商品マスタを読み込んでインデックスを構築
+        読み込み開始後にコミットされた変更は構築後に適用し直す（読み込み結果に含まれていても同じ結果になる）
+        """
+        with self._lock:
+            self._loading = True
+            self._backlog = []
+        try:
+            # 商品マスタより先に読み、これより新しい変更は変更履歴から取り込む
+            version = _fetch_latest_version(db)
+            rows = db.query(ProductMaster.barcode, ProductMaster.product_name).filter(
+                ProductMaster.is_active == 1
+            ).all()
+            with self._lock:
+                self._reset()
+                for barcode, product_name in rows:
+                    self._add(barcode, product_name)
+                for changes in self._backlog:
+                    self._apply(changes)
+                self.version = version
+                self._refreshed_at = time.monotonic()
+                self.loaded = True
+        finally:
+            with self._lock:
+                self._loading = False
+                self._backlog = []
+        print(f"商品名検索インデックス構築: {len(rows)}件")
+
+    def ensure_loaded(self, db):
+        """
+        未構築の場合のみ構築（起動時の構築とリクエストが重なっても1回だけ実行）
+        """
+        if self.loaded:
+            return
+        with self._build_lock:
+            if not self.loaded:
+                self.load(db)
+
+    def refresh(self, db) -> int:
+        """
+        変更履歴から、取り込み済みバージョンより新しい商品の変更を反映（他ワーカー・他プロセスの変更も含む）
+        戻り値は読み込んだ変更履歴の件数
+        """
+        if not self.loaded:
+            return 0
+        if self.version is None:
+            # 構築時に変更履歴を読めなかった場合は、読めるようになった時点から取り込む
+            self.version = _fetch_latest_version(db)
+            return 0
+        logs = db.query(
+            PriceChangeLog.version, PriceChangeLog.barcode, PriceChangeLog.product_name, PriceChangeLog.is_active
+        ).filter(
+            PriceChangeLog.version > self.version,
+            PriceChangeLog.change_type == "product"
+        ).order_by(PriceChangeLog.version).limit(REFRESH_LIMIT).all()
+        if not logs:
+            return 0
+        changes: Dict[str, Optional[Tuple[str, int]]] = {}
+        for _, barcode, product_name, is_active in logs:
+            if not is_active:
+                changes[barcode] = None
+            elif product_name is not None:
+                changes[barcode] = (product_name, is_active)
+        with self._lock:
+            self._apply(changes)
+            self.version = max(self.version, logs[-1][0])
+            self._compact_if_needed()
+        return len(logs)
+
+    def ensure_fresh(self, db):
+        """
+        未構築なら構築し、前回の確認から REFRESH_INTERVAL_SECONDS 以上経っていれば変更履歴を取り込む
+        変更履歴の取り込みに失敗しても、構築済みのインデックスで検索を続ける
+        """
+        self.ensure_loaded(db)
+        if time.monotonic() - self._refreshed_at < REFRESH_INTERVAL_SECONDS:
+            return
+        if not self._refresh_lock.acquire(blocking=False):
+            return  # 他のリクエストが取り込み中
+        try:
+            while self.refresh(db) >= REFRESH_LIMIT:
+                pass
+        except Exception as e:
+            print(f"商品名検索インデックス更新エラー: {str(e)}")
+        finally:
+            self._refreshed_at = time.monotonic()
+            self._refresh_lock.release()
+
+    def upsert(self, barcode: str, product_name: str, is_active: int = 1):
+        """
+        商品の追加・更新（無効化された商品はインデックスから除外）
+        """
+        with self._lock:
+            self._remove(barcode)
+            if is_active:
+                self._add(barcode, product_name)
+            self._compact_if_needed()
+
+    def remove(self, barcode: str):
+        """
+        商品の削除
+        """
+        with self._lock:
+            self._remove(barcode)
+            self._compact_if_needed()
+
+    def apply_changes(self, changes: Dict[str, Optional[Tuple[str, int]]]):
+        """
+        コミットされた商品マスタの変更（バーコード -> (商品名, 有効フラグ)、削除はNone）を反映
+        構築中は構築完了後に適用するため保留し、未構築（構築も始まっていない）の場合は何もしない
+        """
+        with self._lock:
+            if not self.loaded:
+                if self._loading:
+                    self._backlog.append(changes)
+                return
+            self._apply(changes)
+            self._compact_if_needed()
+
+    def search(self, query: str, limit: int = 20) -> List[str]:
+        """
+        商品名検索（完全一致 > 前方一致 > 部分一致の順、同順位は出現位置・名前の短さ順）
+        1文字のクエリは前方一致のみ
+        戻り値はバーコードのリスト
+        """
+        q = normalize_name(query)
+        if not q or limit <= 0:
+            return []
+
+        with self._lock:
+            names = self._names
+            if len(q) < NGRAM_SIZE:
+                # 先頭文字の索引は全件が前方一致のため、名前の短さ順（1文字なら完全一致）だけで並べる
+                best = heapq.nsmallest(limit, (
+                    (len(names[doc_id]), doc_id)
+                    for doc_id in self._prefixes.get(q, ()) if names[doc_id] is not None
+                ))
+                return [self._barcodes[doc_id] for _, doc_id in best]
+
+            postings = [self._postings.get(gram) for gram in _ngrams(q)]
+            if not all(postings):
+                return []
+            candidates = min(postings, key=len)
+
+            hits: List[Tuple[int, int, int, int]] = []
+            for doc_id in candidates:
+                name = names[doc_id]
+                if name is None:
+                    continue
+                pos = name.find(q)
+                if pos < 0:
+                    continue
+                rank = 0 if name == q else (1 if pos == 0 else 2)
+                hits.append((rank, pos, len(name), doc_id))
+
+            best = heapq.nsmallest(limit, hits)
+            return [self._barcodes[doc_id] for _, _, _, doc_id in best]
+
+    def __len__(self):
+        return len(self._doc_ids)
+
+    # 以下はロック取得済みの前提で呼ぶ内部処理
+    def _add(self, barcode: str, product_name: str):
+        name = normalize_name(product_name)
+        doc_id = len(self._names)
+        self._names.append(name)
+        self._barcodes.append(barcode)
+        self._doc_ids[barcode] = doc_id
+        for gram in _ngrams(name):
+            posting = self._postings.get(gram)
+            if posting is None:
+                posting = self._postings[gram] = array("i")
+            posting.append(doc_id)
+        if name:
+            posting = self._prefixes.get(name[0])
+            if posting is None:
+                posting = self._prefixes[name[0]] = array("i")
+            posting.append(doc_id)
+
+    def _apply(self, changes: Dict[str, Optional[Tuple[str, int]]]):
+        for barcode, change in changes.items():
+            self._remove(barcode)
+            if change is not None and change[1]:
+                self._add(barcode, change[0])
+
+    def _remove(self, barcode: str):
+        doc_id = self._doc_ids.pop(barcode, None)
+        if doc_id is not None:
+            self._names[doc_id] = None
+            self._barcodes[doc_id] = None
+            self._dead += 1
+
+    def _compact_if_needed(self):
+        if self._dead <= max(1024, len(self._doc_ids)):
+            return
+        live = [
+            (barcode, name) for barcode, name in zip(self._barcodes, self._names)
+            if name is not None
+        ]
+        self._reset()
+        for barcode, name in live:
+            # 正規化済みの名前は再正規化しても変わらない
+            self._add(barcode, name)
+
+
+def _fetch_latest_version(db) -> Optional[int]:
+    try:
+        return db.query(func.max(PriceChangeLog.version)).scalar() or 0
+    except Exception as e:
+        print(f"価格変更履歴の読み込みエラー（商品名検索インデックスは変更を取り込みません）: {str(e)}")
+        db.rollback()
+        return None
+
+
+product_search_index = ProductSearchIndex()
+
+
+# ORM経由の商品マスタ変更をコミット時にインデックスへ反映
+_PENDING_KEY = "product_search_pending"
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_product_changes(session, flush_context):
+    pending = session.info.setdefault(_PENDING_KEY, {})
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, ProductMaster):
+            pending[obj.barcode] = (obj.product_name, obj.is_active)
+    for obj in session.deleted:
+        if isinstance(obj, ProductMaster):
+            pending[obj.barcode] = None
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_product_changes(session):
+    pending = session.info.pop(_PENDING_KEY, None)
+    if pending:
+        product_search_index.apply_changes(pending)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_product_changes(session, previous_transaction):
+    session.info.pop(_PENDING_KEY, None)
+
+
+if __name__ == "__main__":
+    # 簡易ベンチマーク: python -m db_control.product_search
+    import random
+
+    # 実カタログに近い分布になるよう、語をランダムに組み合わせた商品名を生成
+    words = ["ボールペン", "ノート", "消しゴム", "えんぴつ", "定規", "インク", "ﾏｰｶｰ", "ＡＢＣ", "ファイル", "のり"]
+    # 約5%の商品名に含まれる一般的な語（ポスティングが長くなる場合の計測用）
+    common = "詰め替え用"
+    kana = [chr(c) for c in range(0x30A2, 0x30F3)] + [chr(c) for c in range(0x4E00, 0x4F00)]
+    random.seed(0)
+    index = ProductSearchIndex()
+    start = time.perf_counter()
+    with index._lock:
+        for i in range(1_000_000):
+            name = "".join(random.choices(kana, k=random.randint(4, 10)))
+            if i % 1000 == 0:
+                name = f"{random.choice(words)} {name}"
+            if i % 20 == 0:
+                name = f"{name} {common}"
+            index._add(f"{i:013d}", name)
+        index.loaded = True
+    print(f"構築: {time.perf_counter() - start:.2f}s / {len(index)}件")
+
+    for q in ["ボールペン", "まーかー", "abc", "ファイル", "ノ", "ボ", common, "詰め"]:
+        start = time.perf_counter()
+        result = index.search(q)
+        print(f"検索 '{q}': {len(result)}件 {(time.perf_counter() - start) * 1000:.1f}ms")
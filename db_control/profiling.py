@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+リクエスト単位のプロファイリングとスロークエリ記録（オプトイン）
+
+環境変数 PROFILING_ENABLED=1 の場合のみミドルウェア・SQLフック・ルートのラップを登録する。
+無効時は何も登録しないため、通常のリクエストには一切コストがかからない。
+
+有効時に次のリクエストを計測する。
+- リクエストヘッダー X-Profile: 1 と PROFILE_ADMIN_TOKEN のBearerトークンが付いたリクエスト（常に保存）
+  トークンが無い・一致しない場合の X-Profile は無視する（未認証のクライアントが計測・ディスク書き込みを強制できないように）
+- PROFILE_SAMPLE_RATE（0〜1）の確率で抽出したリクエスト（PROFILE_SLOW_MS 以上かかった場合のみ保存）
+計測内容はPythonプロファイル（cProfile）と engine 経由で実行された全SQLとその所要時間。
+保存先は PROFILE_DIR 配下の件数上限付きリングバッファ（古いものから削除）。
+"""
+
+import cProfile
+import functools
+import hmac
+import inspect
+import io
+import json
+import os
+import pstats
+import random
+import threading
+import time
+import uuid
+from contextvars import ContextVar
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional
+
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+from starlette.concurrency import run_in_threadpool
+
+PROFILE_HEADER = "x-profile"
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "500"))
+PROFILE_MAX_CAPTURES = int(os.getenv("PROFILE_MAX_CAPTURES", "50"))
+PROFILE_DIR = Path(os.getenv("PROFILE_DIR", str(Path(__file__).resolve().parent.parent / "profiles")))
+# SQL文の保存上限文字数（巨大なIN句などでキャプチャが肥大化しないように）
+MAX_STATEMENT_LENGTH = 2000
+
+
+def is_profiling_enabled() -> bool:
+    return os.getenv("PROFILING_ENABLED", "0").lower() in ("1", "true", "yes")
+
+
+def is_profile_admin_token(token: Optional[str]) -> bool:
+    """
+    PROFILE_ADMIN_TOKEN と一致するか（未設定の場合は常にFalse）
+    """
+    admin_token = os.getenv("PROFILE_ADMIN_TOKEN")
+    if not admin_token or not token:
+        return False
+    return hmac.compare_digest(token.encode(), admin_token.encode())
+
+
+def _bearer_token(authorization: Optional[str]) -> Optional[str]:
+    scheme, _, token = (authorization or "").partition(" ")
+    return token.strip() if scheme.lower() == "bearer" else None
+
+
+class ProfileCapture:
+    """
+    1リクエスト分の計測結果
+    """
+
+    def __init__(self, method: str, path: str, forced: bool):
+        self.capture_id = f"{datetime.now():%Y%m%d%H%M%S%f}_{uuid.uuid4().hex[:8]}"
+        self.method = method
+        self.path = path
+        self.forced = forced
+        self.profiler = cProfile.Profile()
+        self.queries: List[dict] = []
+        self.status_code = None
+        self.elapsed_ms = 0.0
+        self._lock = threading.Lock()
+
+    def add_query(self, statement: str, elapsed_ms: float, executemany: bool):
+        with self._lock:
+            self.queries.append({
+                "statement": statement[:MAX_STATEMENT_LENGTH],
+                "elapsed_ms": round(elapsed_ms, 3),
+                "executemany": executemany,
+            })
+
+    def to_dict(self) -> dict:
+        stream = io.StringIO()
+        try:
+            pstats.Stats(self.profiler, stream=stream).sort_stats("cumulative").print_stats(50)
+        except TypeError:
+            # プロファイル対象の関数が実行されなかった場合（統計が空）
+            stream.write("(no profile data)")
+        return {
+            "capture_id": self.capture_id,
+            "method": self.method,
+            "path": self.path,
+            "status_code": self.status_code,
+            "elapsed_ms": round(self.elapsed_ms, 3),
+            "sql_count": len(self.queries),
+            "sql_elapsed_ms": round(sum(q["elapsed_ms"] for q in self.queries), 3),
+            "queries": self.queries,
+            "profile": stream.getvalue(),
+        }
+
+
+current_capture: ContextVar[Optional[ProfileCapture]] = ContextVar("current_capture", default=None)
+
+
+def install_sql_hooks(engine):
+    """
+    計測中のリクエストで実行されたSQLを記録するフックを登録
+    """
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if current_capture.get() is not None:
+            conn.info.setdefault("profile_query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        capture = current_capture.get()
+        if capture is None:
+            return
+        starts = conn.info.get("profile_query_start")
+        if starts:
+            capture.add_query(statement, (time.perf_counter() - starts.pop()) * 1000, executemany)
+
+
+class ProfilingRoute(APIRoute):
+    """
+    同期エンドポイントをプロファイラ付きで実行するルート
+    （同期エンドポイントはスレッドプールで実行されるため、ミドルウェア側のプロファイラでは捕捉できない）
+    """
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        if not inspect.iscoroutinefunction(endpoint) and not inspect.isasyncgenfunction(endpoint):
+            endpoint = _profiled(endpoint)
+        super().__init__(path, endpoint, **kwargs)
+
+
+def _profiled(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        capture = current_capture.get()
+        if capture is None:
+            return func(*args, **kwargs)
+        capture.profiler.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            capture.profiler.disable()
+    return wrapper
+
+
+async def profiling_middleware(request, call_next):
+    """
+    計測対象のリクエストだけ ProfileCapture を設定して処理し、必要に応じて保存
+    """
+    forced = request.headers.get(PROFILE_HEADER) == "1" and is_profile_admin_token(
+        _bearer_token(request.headers.get("authorization"))
+    )
+    if not forced and (PROFILE_SAMPLE_RATE <= 0 or random.random() >= PROFILE_SAMPLE_RATE):
+        return await call_next(request)
+
+    capture = ProfileCapture(request.method, request.url.path, forced)
+    token = current_capture.set(capture)
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        current_capture.reset(token)
+    capture.elapsed_ms = (time.perf_counter() - start) * 1000
+    capture.status_code = response.status_code
+
+    if forced or capture.elapsed_ms >= PROFILE_SLOW_MS:
+        try:
+            # 集計・ファイル書き込みでイベントループ（SSE配信など）を止めないようスレッドプールで実行
+            await run_in_threadpool(save_capture, capture)
+            response.headers["X-Profile-Id"] = capture.capture_id
+        except Exception as e:
+            print(f"プロファイル保存エラー: {str(e)}")
+    return response
+
+
+_save_lock = threading.Lock()
+
+
+def save_capture(capture: ProfileCapture):
+    """
+    計測結果をJSON（SQL・プロファイル要約）と .prof（pstats形式）で保存し、上限を超えた古いものを削除
+    """
+    PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+    with _save_lock:
+        (PROFILE_DIR / f"{capture.capture_id}.json").write_text(
+            json.dumps(capture.to_dict(), ensure_ascii=False, indent=2), encoding="utf-8"
+        )
+        try:
+            capture.profiler.dump_stats(str(PROFILE_DIR / f"{capture.capture_id}.prof"))
+        except TypeError:
+            pass
+        # キャプチャIDは日時始まりのため、ファイル名の降順がそのまま新しい順になる
+        for old in sorted(PROFILE_DIR.glob("*.json"), reverse=True)[PROFILE_MAX_CAPTURES:]:
+            old.unlink(missing_ok=True)
+            old.with_suffix(".prof").unlink(missing_ok=True)
+
+
+def list_captures() -> List[dict]:
+    """
+    保存済みキャプチャ一覧（新しい順）
+    """
+    if not PROFILE_DIR.exists():
+        return []
+    captures = []
+    for path in sorted(PROFILE_DIR.glob("*.json"), reverse=True):
+        try:
+            data = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            continue
+        captures.append({
+            key: data.get(key)
+            for key in ("capture_id", "method", "path", "status_code", "elapsed_ms", "sql_count", "sql_elapsed_ms")
+        })
+    return captures
+
+
+def capture_path(capture_id: str, suffix: str) -> Optional[Path]:
+    """
+    キャプチャファイルのパス（IDの形式が不正、または存在しない場合はNone）
+    """
+    if not capture_id.replace("_", "").isalnum():
+        return None
+    path = PROFILE_DIR / f"{capture_id}{suffix}"
+    return path if path.exists() else None
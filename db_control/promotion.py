@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+"""
+プロモーション（まとめ買い・セット・時間帯値引）の適用エンジン
+
+プロモーションマスタをバーコードをキーにした索引へコンパイルしておき、
+カートに含まれるバーコードから該当ルールだけを引いて適用する。
+ルール総数に関係なく O(明細数 + 該当ルール数) で計算できる。
+"""
+
+import threading
+import time as time_module
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+from db_control.mymodels_MySQL import PromotionMaster, PromotionItem
+
+MULTI_BUY = "MULTI_BUY"
+BUNDLE = "BUNDLE"
+TIME_DISCOUNT = "TIME_DISCOUNT"
+
+# マスタ変更を取り込むまでの最大秒数
+REFRESH_INTERVAL_SECONDS = 60
+
+
+class CompiledPromotion:
+    """
+    コンパイル済みプロモーションルール
+    """
+    __slots__ = (
+        "promotion_id", "promotion_name", "promotion_type", "required_quantity",
+        "promo_price", "discount_rate", "discount_amount", "start_datetime",
+        "end_datetime", "daily_start_time", "daily_end_time", "priority", "items"
+    )
+
+    def __init__(self, promotion: PromotionMaster, items: Dict[str, int]):
+        self.promotion_id = promotion.promotion_id
+        self.promotion_name = promotion.promotion_name
+        self.promotion_type = promotion.promotion_type
+        self.required_quantity = promotion.required_quantity
+        self.promo_price = promotion.promo_price
+        self.discount_rate = float(promotion.discount_rate) if promotion.discount_rate is not None else None
+        self.discount_amount = promotion.discount_amount
+        self.start_datetime = promotion.start_datetime
+        self.end_datetime = promotion.end_datetime
+        self.daily_start_time = promotion.daily_start_time
+        self.daily_end_time = promotion.daily_end_time
+        self.priority = promotion.priority if promotion.priority is not None else 100
+        self.items = items  # バーコード -> 構成数量
+
+    def is_active_at(self, now: datetime) -> bool:
+        if now < self.start_datetime:
+            return False
+        if self.end_datetime is not None and now >= self.end_datetime:
+            return False
+        if self.daily_start_time is None or self.daily_end_time is None:
+            return True
+        current = now.time()
+        if self.daily_start_time <= self.daily_end_time:
+            return self.daily_start_time <= current < self.daily_end_time
+        # 日付をまたぐ時間帯（例: 22:00〜02:00）
+        return current >= self.daily_start_time or current < self.daily_end_time
+
+    def summary(self) -> dict:
+        return {
+            "promotion_id": self.promotion_id,
+            "promotion_name": self.promotion_name,
+            "promotion_type": self.promotion_type,
+        }
+
+
+def _allocate(total: int, weights: List[int]) -> List[int]:
+    """
+    値引額を重みに比例して整数配分（端数は小数部の大きい順に1円ずつ）
+    total が重みの合計以下であれば、各要素の配分額は自身の重みを超えない
+    """
+    weight_sum = sum(weights)
+    if weight_sum <= 0:
+        return [0] * len(weights)
+    shares = [total * w // weight_sum for w in weights]
+    remainder = total - sum(shares)
+    order = sorted(range(len(weights)), key=lambda i: (-(total * weights[i] % weight_sum), i))
+    for i in order[:remainder]:
+        shares[i] += 1
+    return shares
+
+
+def _take(line_indexes: List[int], count: int, remaining: List[int]) -> List[Tuple[int, int]]:
+    """
+    明細（単価の高い順に並べたもの）から count 点を充当する (明細番号, 点数) のリスト
+    remaining は変更しない
+    """
+    taken = []
+    for i in line_indexes:
+        if count <= 0:
+            break
+        units = min(count, remaining[i])
+        if units > 0:
+            taken.append((i, units))
+            count -= units
+    return taken
+
+
+def _allocate_to_lines(discount: int, consumed: List[Tuple[int, int]], lines) -> Dict[int, int]:
+    """
+    充当した明細へ、充当分の金額に比例して値引額を配分
+    """
+    weights = [lines[i][1] * units for i, units in consumed]
+    result: Dict[int, int] = {}
+    for (i, _), amount in zip(consumed, _allocate(discount, weights)):
+        result[i] = result.get(i, 0) + amount
+    return result
+
+
+def discounted_line_amounts(unit_price: int, quantity: int, discount: int, tax_rate: float) -> Tuple[int, int, int]:
+    """
+    値引後の明細金額を再計算
+    戻り値: (小計（税抜）, 消費税額（切り捨て）, 小計（税込）)
+    """
+    subtotal_excl_tax = unit_price * quantity - discount
+    tax_amount = int(subtotal_excl_tax * tax_rate)
+    return subtotal_excl_tax, tax_amount, subtotal_excl_tax + tax_amount
+
+
+class PromotionEngine:
+    """
+    コンパイル済みプロモーション索引
+
+    - 索引はバーコード -> ルールのタプル（優先度順）
+    - 期限切れのルールはコンパイル時に除外し、期間・時間帯は適用時に判定
+    - 再コンパイルは索引を丸ごと差し替えるため、適用中のリクエストに影響しない
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._index: Dict[str, Tuple[CompiledPromotion, ...]] = {}
+        self._loaded_at = None
+
+    def load(self, db, now: datetime = None):
+        """
+        有効なプロモーションを読み込んで索引をコンパイル
+        """
+        now = now or datetime.now()
+        promotions = db.query(PromotionMaster).filter(
+            PromotionMaster.is_active == 1,
+            (PromotionMaster.end_datetime.is_(None)) | (PromotionMaster.end_datetime > now)
+        ).all()
+        items = db.query(PromotionItem.promotion_id, PromotionItem.barcode, PromotionItem.quantity).join(
+            PromotionMaster, PromotionItem.promotion_id == PromotionMaster.promotion_id
+        ).filter(
+            PromotionMaster.is_active == 1
+        ).all()
+        self.compile(promotions, items)
+
+    def compile(self, promotions, items):
+        """
+        プロモーションと対象商品から索引を作成
+        """
+        items_by_promotion: Dict[str, Dict[str, int]] = {}
+        for promotion_id, barcode, quantity in items:
+            items_by_promotion.setdefault(promotion_id, {})[barcode] = quantity or 1
+
+        index: Dict[str, List[CompiledPromotion]] = {}
+        for promotion in promotions:
+            rule_items = items_by_promotion.get(promotion.promotion_id)
+            if not rule_items:
+                continue
+            rule = CompiledPromotion(promotion, rule_items)
+            for barcode in rule_items:
+                index.setdefault(barcode, []).append(rule)
+
+        compiled = {
+            barcode: tuple(sorted(rules, key=lambda r: (r.priority, r.promotion_id)))
+            for barcode, rules in index.items()
+        }
+        self._index = compiled
+        self._loaded_at = time_module.monotonic()
+        print(f"プロモーション索引コンパイル: {len(promotions)}件 / 対象商品{len(compiled)}件")
+
+    def ensure_fresh(self, db):
+        """
+        索引が未作成または古い場合に再コンパイル
+
+        読み込みに失敗した場合は直前の索引（未作成なら空）のまま販売を続け、
+        次の再読み込みまで REFRESH_INTERVAL_SECONDS 待つ
+        """
+        if self._loaded_at is not None and time_module.monotonic() - self._loaded_at < REFRESH_INTERVAL_SECONDS:
+            return
+        with self._lock:
+            if self._loaded_at is None or time_module.monotonic() - self._loaded_at >= REFRESH_INTERVAL_SECONDS:
+                try:
+                    self.load(db)
+                except Exception as e:
+                    print(f"プロモーション索引の読み込みエラー（直前の索引で継続）: {str(e)}")
+                    db.rollback()
+                    self._loaded_at = time_module.monotonic()
+
+    def promotions_for(self, barcode: str, now: datetime = None) -> List[dict]:
+        """
+        商品に現在適用可能なプロモーション一覧
+        """
+        now = now or datetime.now()
+        return [rule.summary() for rule in self._index.get(barcode, ()) if rule.is_active_at(now)]
+
+    def apply(self, lines: List[Tuple[str, int, int]], now: datetime = None):
+        """
+        カートへプロモーションを適用
+
+        lines: (バーコード, 単価（税抜）, 数量) のリスト
+        戻り値: (明細ごとの値引額リスト, 適用プロモーション一覧)
+        """
+        now = now or datetime.now()
+        index = self._index
+
+        # 明細ごとの残数量と、バーコードごとの明細番号（単価の高い順）
+        remaining = [quantity for _, _, quantity in lines]
+        lines_by_barcode: Dict[str, List[int]] = {}
+        for i, (barcode, _, _) in enumerate(lines):
+            lines_by_barcode.setdefault(barcode, []).append(i)
+        for indexes in lines_by_barcode.values():
+            indexes.sort(key=lambda i: -lines[i][1])
+
+        # カート内のバーコードから該当ルールのみ収集
+        seen = set()
+        rules: List[CompiledPromotion] = []
+        for barcode in lines_by_barcode:
+            for rule in index.get(barcode, ()):
+                if rule.promotion_id not in seen:
+                    seen.add(rule.promotion_id)
+                    if rule.is_active_at(now):
+                        rules.append(rule)
+        rules.sort(key=lambda r: (r.priority, r.promotion_id))
+
+        line_discounts = [0] * len(lines)
+        applied = []
+        for rule in rules:
+            if rule.promotion_type == BUNDLE:
+                result = self._apply_bundle(rule, lines, remaining, lines_by_barcode)
+            elif rule.promotion_type == MULTI_BUY:
+                result = self._apply_multi_buy(rule, lines, remaining, lines_by_barcode)
+            elif rule.promotion_type == TIME_DISCOUNT:
+                result = self._apply_time_discount(rule, lines, remaining, lines_by_barcode)
+            else:
+                continue
+            if result is None:
+                continue
+            applied_count, discounts = result
+            for i, amount in discounts.items():
+                line_discounts[i] += amount
+            applied.append({
+                **rule.summary(),
+                "applied_count": applied_count,
+                "discount_amount": sum(discounts.values()),
+            })
+
+        return line_discounts, applied
+
+    @staticmethod
+    def _apply_bundle(rule, lines, remaining, lines_by_barcode):
+        """
+        セット: 構成商品を全て所定数量そろえたセット数だけセット価格にする
+        """
+        sets = min(
+            sum(remaining[i] for i in lines_by_barcode.get(barcode, ())) // quantity
+            for barcode, quantity in rule.items.items()
+        )
+        if sets <= 0 or rule.promo_price is None:
+            return None
+        consumed = []
+        for barcode, quantity in rule.items.items():
+            consumed.extend(_take(lines_by_barcode[barcode], quantity * sets, remaining))
+        discount = sum(lines[i][1] * units for i, units in consumed) - rule.promo_price * sets
+        if discount <= 0:
+            return None
+        for i, units in consumed:
+            remaining[i] -= units
+        return sets, _allocate_to_lines(discount, consumed, lines)
+
+    @staticmethod
+    def _apply_multi_buy(rule, lines, remaining, lines_by_barcode):
+        """
+        まとめ買い: 対象商品（組み合わせ自由）N点ごとにセット価格にする
+        単価の高い明細から充当する
+        """
+        if not rule.required_quantity or rule.promo_price is None:
+            return None
+        pool = sorted(
+            (i for barcode in rule.items for i in lines_by_barcode.get(barcode, ()) if remaining[i] > 0),
+            key=lambda i: (-lines[i][1], i)
+        )
+        sets = sum(remaining[i] for i in pool) // rule.required_quantity
+        if sets <= 0:
+            return None
+        consumed = _take(pool, sets * rule.required_quantity, remaining)
+        discount = sum(lines[i][1] * units for i, units in consumed) - rule.promo_price * sets
+        if discount <= 0:
+            return None
+        for i, units in consumed:
+            remaining[i] -= units
+        return sets, _allocate_to_lines(discount, consumed, lines)
+
+    @staticmethod
+    def _apply_time_discount(rule, lines, remaining, lines_by_barcode):
+        """
+        時間帯値引: 対象商品1点ごとに、その明細の単価から値引額または値引率で値引する
+        """
+        discounts = {}
+        applied_count = 0
+        for barcode in rule.items:
+            for i in lines_by_barcode.get(barcode, ()):
+                quantity = remaining[i]
+                if quantity <= 0:
+                    continue
+                price = lines[i][1]
+                if rule.discount_amount is not None:
+                    per_unit = min(rule.discount_amount, price)
+                elif rule.discount_rate is not None:
+                    per_unit = int(price * rule.discount_rate)
+                else:
+                    continue
+                if per_unit <= 0:
+                    continue
+                discounts[i] = per_unit * quantity
+                applied_count += quantity
+                remaining[i] = 0
+        if not discounts:
+            return None
+        return applied_count, discounts
+
+
+promotion_engine = PromotionEngine()
+
+
+if __name__ == "__main__":
+    # 簡易ベンチマーク: python -m db_control.promotion
+    import random
+    from datetime import timedelta, time
+
+    random.seed(0)
+    now = datetime.now()
+    barcodes = [f"49{i:011d}" for i in range(100_000)]
+    promotions, items = [], []
+    kinds = [MULTI_BUY, BUNDLE, TIME_DISCOUNT]
+    for i in range(5000):
+        kind = kinds[i % 3]
+        promotion = PromotionMaster(
+            promotion_id=f"P{i:05d}", promotion_name=f"プロモーション{i}", promotion_type=kind,
+            required_quantity=2 if kind == MULTI_BUY else None,
+            promo_price=150 if kind != TIME_DISCOUNT else None,
+            discount_rate=0.2 if kind == TIME_DISCOUNT else None,
+            start_datetime=now - timedelta(days=1), end_datetime=now + timedelta(days=1),
+            daily_start_time=time(0, 0) if kind == TIME_DISCOUNT else None,
+            daily_end_time=time(23, 59) if kind == TIME_DISCOUNT else None,
+            priority=random.randint(1, 100)
+        )
+        promotions.append(promotion)
+        for barcode in random.sample(barcodes, 3):
+            items.append((promotion.promotion_id, barcode, 1))
+
+    engine = PromotionEngine()
+    start = time_module.perf_counter()
+    engine.compile(promotions, items)
+    print(f"コンパイル: {(time_module.perf_counter() - start) * 1000:.1f}ms")
+
+    promoted = [barcode for _, barcode, _ in items]
+    carts = [
+        [(random.choice(promoted if random.random() < 0.5 else barcodes), 100, random.randint(1, 3))
+         for _ in range(30)]
+        for _ in range(1000)
+    ]
+    start = time_module.perf_counter()
+    applied_total = 0
+    for cart in carts:
+        _, applied = engine.apply(cart, now)
+        applied_total += len(applied)
+    elapsed = time_module.perf_counter() - start
+    print(f"適用: 30明細 x {len(carts)}カート {elapsed * 1000:.1f}ms "
+          f"(1カート {elapsed * 1000 / len(carts):.3f}ms, 適用{applied_total}件)")
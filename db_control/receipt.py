@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+取引照会（レシート再発行・返品・監査用）
+
+取引ヘッダー・明細・適用プロモーションは常にまとめて取得し、1件ずつ遅延ロードしない。
+- 取引ID指定: ヘッダー1回 + 明細1回 + プロモーション1回
+- 端末ごとの直近取引: キーセットページングでヘッダー1回 + 対象取引の明細1回 + プロモーション1回
+購入直後の再発行はDBを参照しないよう、端末ごとに直近N件をLRUキャッシュに保持する。
+"""
+
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import and_, or_
+
+from db_control.mymodels_MySQL import TransactionData, TransactionDetail, TransactionPromotion
+from db_control.partitioning import transaction_id_range
+
+
+def _details_by_transaction(db, transaction_ids: List[str]) -> Dict[str, List[TransactionDetail]]:
+    details: Dict[str, List[TransactionDetail]] = {tid: [] for tid in transaction_ids}
+    if not transaction_ids:
+        return details
+    # 明細IDは「取引ID_連番」のため、主キーの範囲条件を付けて主キー範囲走査・パーティション絞り込みを効かせる
+    rows = db.query(TransactionDetail).filter(
+        TransactionDetail.transaction_id.in_(transaction_ids),
+        or_(*[
+            and_(TransactionDetail.detail_id > f"{tid}_", TransactionDetail.detail_id < f"{tid}`")
+            for tid in transaction_ids
+        ])
+    ).order_by(TransactionDetail.transaction_id, TransactionDetail.detail_id).all()
+    for detail in rows:
+        details[detail.transaction_id].append(detail)
+    return details
+
+
+def _promotions_by_transaction(db, transaction_ids: List[str]) -> Dict[str, List[TransactionPromotion]]:
+    promotions: Dict[str, List[TransactionPromotion]] = {tid: [] for tid in transaction_ids}
+    if not transaction_ids:
+        return promotions
+    rows = db.query(TransactionPromotion).filter(
+        TransactionPromotion.transaction_id.in_(transaction_ids)
+    ).order_by(TransactionPromotion.transaction_id, TransactionPromotion.promotion_id).all()
+    for promotion in rows:
+        promotions[promotion.transaction_id].append(promotion)
+    return promotions
+
+
+def load_transaction(
+    db, transaction_id: str
+) -> Optional[Tuple[TransactionData, List[TransactionDetail], List[TransactionPromotion]]]:
+    """
+    取引IDで取引ヘッダー・明細・適用プロモーションを取得
+    """
+    header = db.get(TransactionData, transaction_id)
+    if header is None:
+        return None
+    return (
+        header,
+        _details_by_transaction(db, [transaction_id])[transaction_id],
+        _promotions_by_transaction(db, [transaction_id])[transaction_id],
+    )
+
+
+def encode_cursor(header: TransactionData) -> str:
+    return f"{header.transaction_datetime.isoformat()}|{header.transaction_id}"
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, str]:
+    """
+    ページングカーソル（取引日時|取引ID）の解析
+    """
+    transaction_datetime, transaction_id = cursor.split("|", 1)
+    return datetime.fromisoformat(transaction_datetime), transaction_id
+
+
+def load_recent_transactions(
+    db, store_code: str, pos_machine_id: str, limit: int, before: Optional[str] = None
+) -> Tuple[List[Tuple[TransactionData, List[TransactionDetail], List[TransactionPromotion]]], Optional[str]]:
+    """
+    端末の直近取引を新しい順に取得（キーセットページング）
+    戻り値: (取引リスト, 次ページのカーソル)
+    """
+    query = db.query(TransactionData).filter(
+        TransactionData.store_code == store_code,
+        TransactionData.pos_machine_id == pos_machine_id
+    )
+    if before:
+        before_datetime, before_id = decode_cursor(before)
+        query = query.filter(
+            or_(
+                TransactionData.transaction_datetime < before_datetime,
+                and_(
+                    TransactionData.transaction_datetime == before_datetime,
+                    TransactionData.transaction_id < before_id
+                )
+            ),
+            # 取引日時 <= before_datetime の範囲を取引IDでも指定し、それより先の月のパーティションを除外
+            *transaction_id_range(end=before_datetime + timedelta(microseconds=1))
+        )
+    headers = query.order_by(
+        TransactionData.transaction_datetime.desc(),
+        TransactionData.transaction_id.desc()
+    ).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(headers) > limit:
+        headers = headers[:limit]
+        next_cursor = encode_cursor(headers[-1])
+
+    transaction_ids = [h.transaction_id for h in headers]
+    details = _details_by_transaction(db, transaction_ids)
+    promotions = _promotions_by_transaction(db, transaction_ids)
+    return [(h, details[h.transaction_id], promotions[h.transaction_id]) for h in headers], next_cursor
+
+
+class ReceiptCache:
+    """
+    端末ごとの直近取引LRUキャッシュ
+
+    - 端末（店舗コード, POS機ID）ごとに最大 per_terminal 件
+    - 端末数も max_terminals で上限を設け、最も使われていない端末から破棄
+    """
+
+    def __init__(self, per_terminal: int = 20, max_terminals: int = 1000):
+        self._per_terminal = per_terminal
+        self._max_terminals = max_terminals
+        self._terminals: "OrderedDict[Tuple[str, str], OrderedDict]" = OrderedDict()
+        self._terminal_of: Dict[str, Tuple[str, str]] = {}  # 取引ID -> 端末
+        self._lock = threading.Lock()
+
+    def put(self, store_code: str, pos_machine_id: str, transaction_id: str, receipt):
+        if self._per_terminal <= 0:
+            return
+        key = (store_code, pos_machine_id)
+        with self._lock:
+            entries = self._terminals.get(key)
+            if entries is None:
+                entries = self._terminals[key] = OrderedDict()
+                if len(self._terminals) > self._max_terminals:
+                    _, evicted = self._terminals.popitem(last=False)
+                    for tid in evicted:
+                        self._terminal_of.pop(tid, None)
+            self._terminals.move_to_end(key)
+            entries[transaction_id] = receipt
+            entries.move_to_end(transaction_id)
+            self._terminal_of[transaction_id] = key
+            while len(entries) > self._per_terminal:
+                tid, _ = entries.popitem(last=False)
+                self._terminal_of.pop(tid, None)
+
+    def get(self, transaction_id: str):
+        with self._lock:
+            key = self._terminal_of.get(transaction_id)
+            if key is None:
+                return None
+            self._terminals.move_to_end(key)
+            return self._terminals[key].get(transaction_id)
@@ -1,4 +1,5 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, Header
+from fastapi.responses import StreamingResponse, FileResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
@@ -6,6 +7,7 @@ from typing import List, Optional
 import os
 import hashlib
 import uuid
+import threading
 from datetime import datetime
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import select
@@ -13,7 +15,17 @@ from sqlalchemy import select
 from db_control.connect_MySQL import engine
 from db_control.mymodels_MySQL import (
     CashierMaster, TaxMaster, ProductMaster, 
-    TransactionData, TransactionDetail
+    TransactionData, TransactionDetail, TransactionPromotion
+)
+from db_control.product_search import product_search_index
+from db_control.promotion import promotion_engine, discounted_line_amounts
+from db_control.inventory import InventoryBatcher, decrement_stock, enqueue_decrements, get_low_stock
+from db_control.price_events import PriceEventBroadcaster
+from db_control.partitioning import current_transaction_datetime, generate_transaction_id
+from db_control.receipt import ReceiptCache, load_transaction, load_recent_transactions
+from db_control.profiling import (
+    is_profiling_enabled, install_sql_hooks, profiling_middleware, ProfilingRoute,
+    list_captures, capture_path, is_profile_admin_token
 )
 
 # データベースセッション
@@ -22,6 +34,19 @@ Session = sessionmaker(bind=engine)
 # セキュリティ
 security = HTTPBearer()
 
+# 在庫減算のバッチ時間窓（ミリ秒、0の場合は購入トランザクション内で減算）
+INVENTORY_BATCH_WINDOW_MS = int(os.getenv("INVENTORY_BATCH_WINDOW_MS", "0"))
+inventory_batcher = (
+    InventoryBatcher(Session, INVENTORY_BATCH_WINDOW_MS / 1000)
+    if INVENTORY_BATCH_WINDOW_MS > 0 else None
+)
+
+# 価格変更通知の配信ハブ（ワーカーごと）
+price_event_broadcaster = PriceEventBroadcaster(Session)
+
+# 購入直後のレシート再発行用キャッシュ（端末ごとの直近N件）
+receipt_cache = ReceiptCache(per_terminal=int(os.getenv("RECEIPT_CACHE_SIZE", "20")))
+
 # Pydanticモデル
 class LoginRequest(BaseModel):
     cashier_code: str
@@ -33,6 +58,11 @@ class LoginResponse(BaseModel):
     cashier_name: Optional[str] = None
     token: Optional[str] = None
 
+class PromotionSummary(BaseModel):
+    promotion_id: str
+    promotion_name: str
+    promotion_type: str
+
 class ProductResponse(BaseModel):
     barcode: str
     product_name: str
@@ -40,6 +70,12 @@ class ProductResponse(BaseModel):
     tax_code: str
     tax_rate: float
     price_incl_tax: int
+    promotions: List[PromotionSummary] = []
+
+class ProductSearchResponse(BaseModel):
+    query: str
+    count: int
+    products: List[ProductResponse]
 
 class CartItem(BaseModel):
     barcode: str
@@ -58,6 +94,56 @@ class PurchaseRequest(BaseModel):
     cashier_code: str
     cart_items: List[CartItem]
 
+class AppliedPromotion(PromotionSummary):
+    applied_count: int
+    discount_amount: int
+
+class TransactionDetailResponse(BaseModel):
+    detail_id: str
+    barcode: str
+    product_name: str
+    unit_price: int
+    quantity: int
+    subtotal_excl_tax: int
+    tax_code: str
+    tax_rate: float
+    tax_amount: int
+    subtotal_incl_tax: int
+
+class TransactionPromotionResponse(BaseModel):
+    promotion_id: str
+    promotion_name: str
+    applied_count: int
+    discount_amount: int
+
+class TransactionResponse(BaseModel):
+    transaction_id: str
+    store_code: str
+    pos_machine_id: str
+    cashier_code: str
+    transaction_datetime: datetime
+    total_amount_excl_tax: int
+    total_tax_amount: int
+    total_amount_incl_tax: int
+    total_discount_amount: int = 0
+    details: List[TransactionDetailResponse]
+    applied_promotions: List[TransactionPromotionResponse] = []
+
+class TransactionListResponse(BaseModel):
+    count: int
+    transactions: List[TransactionResponse]
+    next_cursor: Optional[str] = None
+
+class LowStockItem(BaseModel):
+    barcode: str
+    quantity: int
+    reorder_point: int
+
+class LowStockResponse(BaseModel):
+    store_code: str
+    count: int
+    items: List[LowStockItem]
+
 class PurchaseResponse(BaseModel):
     success: bool
     message: str
@@ -65,6 +151,8 @@ class PurchaseResponse(BaseModel):
     total_amount_excl_tax: Optional[int] = None
     total_tax_amount: Optional[int] = None
     total_amount_incl_tax: Optional[int] = None
+    total_discount_amount: Optional[int] = None
+    applied_promotions: List[AppliedPromotion] = []
 
 app = FastAPI(
     title="簡易POSシステム API",
@@ -72,6 +160,13 @@ app = FastAPI(
     version="1.0.0"
 )
 
+# リクエスト単位のプロファイリング（PROFILING_ENABLED=1 の場合のみ登録、無効時はコストなし）
+PROFILING_ENABLED = is_profiling_enabled()
+if PROFILING_ENABLED:
+    app.router.route_class = ProfilingRoute
+    app.middleware("http")(profiling_middleware)
+    install_sql_hooks(engine)
+
 # 環境に応じたCORS設定
 allowed_origins = []
 
@@ -102,6 +197,49 @@ app.add_middleware(
 	allow_headers=["*"],
 )
 
+@app.on_event("startup")
+def build_product_search_index():
+    """商品名検索インデックスをバックグラウンドで構築"""
+    def _build():
+        db = Session()
+        try:
+            product_search_index.ensure_loaded(db)
+        except Exception as e:
+            print(f"商品名検索インデックス構築エラー: {str(e)}")
+        finally:
+            db.close()
+    threading.Thread(target=_build, daemon=True).start()
+
+@app.on_event("startup")
+def start_inventory_batcher():
+    """在庫減算バッチャー起動（バッチ時間窓が設定されている場合のみ）"""
+    if inventory_batcher is not None:
+        inventory_batcher.start()
+    else:
+        # バッチ反映モードから切り替えた場合に残っている減算待ちを反映
+        def _drain():
+            try:
+                InventoryBatcher(Session, 0).drain()
+            except Exception as e:
+                print(f"在庫減算待ち反映エラー: {str(e)}")
+        threading.Thread(target=_drain, daemon=True).start()
+
+@app.on_event("startup")
+async def start_price_event_broadcaster():
+    """価格変更通知の配信開始"""
+    await price_event_broadcaster.start()
+
+@app.on_event("shutdown")
+async def stop_price_event_broadcaster():
+    """価格変更通知の配信停止"""
+    await price_event_broadcaster.stop()
+
+@app.on_event("shutdown")
+def stop_inventory_batcher():
+    """減算待ちを反映してから停止（反映できなかった分は次回起動時に反映）"""
+    if inventory_batcher is not None:
+        inventory_batcher.stop()
+
 # ヘルパー関数
 def get_db():
     """データベースセッション取得"""
@@ -119,12 +257,49 @@ def calculate_tax_amount(price: int, tax_rate: float) -> int:
     """消費税額計算（切り捨て）"""
     return int(price * tax_rate)
 
-def generate_transaction_id(store_code: str, pos_machine_id: str) -> str:
-    """取引ID生成"""
-    now = datetime.now()
-    date_str = now.strftime("%Y%m%d")
-    time_str = now.strftime("%H%M%S")
-    return f"{date_str}_{store_code}_{pos_machine_id}_{time_str}"
+def build_transaction_response(transaction, details, promotions) -> TransactionResponse:
+    """取引ヘッダー・明細・適用プロモーションからレスポンス作成"""
+    promotions = sorted(promotions, key=lambda p: p.promotion_id)
+    return TransactionResponse(
+        transaction_id=transaction.transaction_id,
+        store_code=transaction.store_code,
+        pos_machine_id=transaction.pos_machine_id,
+        cashier_code=transaction.cashier_code,
+        transaction_datetime=transaction.transaction_datetime,
+        total_amount_excl_tax=transaction.total_amount_excl_tax,
+        total_tax_amount=transaction.total_tax_amount,
+        total_amount_incl_tax=transaction.total_amount_incl_tax,
+        total_discount_amount=sum(p.discount_amount for p in promotions),
+        details=[
+            TransactionDetailResponse(
+                detail_id=d.detail_id,
+                barcode=d.barcode,
+                product_name=d.product_name,
+                unit_price=d.unit_price,
+                quantity=d.quantity,
+                subtotal_excl_tax=d.subtotal_excl_tax,
+                tax_code=d.tax_code,
+                tax_rate=d.tax_rate,
+                tax_amount=d.tax_amount,
+                subtotal_incl_tax=d.subtotal_incl_tax
+            ) for d in details
+        ],
+        applied_promotions=[
+            TransactionPromotionResponse(
+                promotion_id=p.promotion_id,
+                promotion_name=p.promotion_name,
+                applied_count=p.applied_count,
+                discount_amount=p.discount_amount
+            ) for p in promotions
+        ]
+    )
+
+def require_profile_admin(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """プロファイル閲覧用の認証（PROFILE_ADMIN_TOKEN と一致するBearerトークンのみ許可）"""
+    if not PROFILING_ENABLED or not os.getenv("PROFILE_ADMIN_TOKEN"):
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not is_profile_admin_token(credentials.credentials):
+        raise HTTPException(status_code=403, detail="認証に失敗しました")
 
 # APIエンドポイント
 @app.get("/")
@@ -171,6 +346,54 @@ def login(request: LoginRequest, db = Depends(get_db)):
         raise HTTPException(status_code=500, detail=f"認証エラー: {str(e)}")
 
 
+# /api/products/{barcode} より先に定義する（"search" がバーコード扱いされないように）
+@app.get("/api/products/search", response_model=ProductSearchResponse)
+def search_products(
+    q: str = Query(..., min_length=1, max_length=100),
+    limit: int = Query(20, ge=1, le=100),
+    db = Depends(get_db)
+):
+    """
+    商品名による商品検索（バーコードの無い商品向け）
+    """
+    try:
+        product_search_index.ensure_fresh(db)
+        promotion_engine.ensure_fresh(db)
+        barcodes = product_search_index.search(q, limit)
+        if not barcodes:
+            return ProductSearchResponse(query=q, count=0, products=[])
+
+        # ヒットした商品のみ主キーで取得し、インデックスの順位順に並べ直す
+        rows = db.query(ProductMaster, TaxMaster).join(
+            TaxMaster, ProductMaster.tax_code == TaxMaster.tax_code
+        ).filter(
+            ProductMaster.barcode.in_(barcodes),
+            ProductMaster.is_active == 1,
+            TaxMaster.is_active == 1
+        ).all()
+        by_barcode = {product.barcode: (product, tax) for product, tax in rows}
+
+        products = []
+        for barcode in barcodes:
+            if barcode not in by_barcode:
+                continue
+            product, tax = by_barcode[barcode]
+            tax_amount = calculate_tax_amount(product.unit_price, tax.tax_rate)
+            products.append(ProductResponse(
+                barcode=product.barcode,
+                product_name=product.product_name,
+                unit_price=product.unit_price,
+                tax_code=product.tax_code,
+                tax_rate=tax.tax_rate,
+                price_incl_tax=product.unit_price + tax_amount,
+                promotions=promotion_engine.promotions_for(product.barcode)
+            ))
+
+        return ProductSearchResponse(query=q, count=len(products), products=products)
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"商品名検索エラー: {str(e)}")
+
 @app.get("/api/products/{barcode}", response_model=ProductResponse)
 def get_product_by_barcode(barcode: str, db = Depends(get_db)):
     """
@@ -208,13 +431,17 @@ def get_product_by_barcode(barcode: str, db = Depends(get_db)):
         tax_amount = calculate_tax_amount(product.unit_price, tax.tax_rate)
         price_incl_tax = product.unit_price + tax_amount
         
+        # 適用可能なプロモーション
+        promotion_engine.ensure_fresh(db)
+        
         return ProductResponse(
             barcode=product.barcode,
             product_name=product.product_name,
             unit_price=product.unit_price,
             tax_code=product.tax_code,
             tax_rate=tax.tax_rate,
-            price_incl_tax=price_incl_tax
+            price_incl_tax=price_incl_tax,
+            promotions=promotion_engine.promotions_for(product.barcode)
         )
         
     except HTTPException:
@@ -231,7 +458,21 @@ def purchase(request: PurchaseRequest, db = Depends(get_db)):
     """
     try:
         # 取引ID生成
-        transaction_id = generate_transaction_id(request.store_code, request.pos_machine_id)
+        transaction_datetime = current_transaction_datetime()
+        transaction_id = generate_transaction_id(request.store_code, request.pos_machine_id, transaction_datetime)
+        
+        # プロモーション適用（値引のある明細は小計・税額を再計算）
+        promotion_engine.ensure_fresh(db)
+        line_discounts, applied_promotions = promotion_engine.apply(
+            [(item.barcode, item.unit_price, item.quantity) for item in request.cart_items],
+            transaction_datetime
+        )
+        for item, discount in zip(request.cart_items, line_discounts):
+            if discount:
+                item.subtotal_excl_tax, item.tax_amount, item.subtotal_incl_tax = discounted_line_amounts(
+                    item.unit_price, item.quantity, discount, item.tax_rate
+                )
+        total_discount_amount = sum(line_discounts)
         
         # 合計金額計算
         total_amount_excl_tax = sum(item.subtotal_excl_tax for item in request.cart_items)
@@ -244,7 +485,7 @@ def purchase(request: PurchaseRequest, db = Depends(get_db)):
             store_code=request.store_code,
             pos_machine_id=request.pos_machine_id,
             cashier_code=request.cashier_code,
-            transaction_datetime=datetime.now(),
+            transaction_datetime=transaction_datetime,
             total_amount_excl_tax=total_amount_excl_tax,
             total_tax_amount=total_tax_amount,
             total_amount_incl_tax=total_amount_incl_tax
@@ -253,6 +494,7 @@ def purchase(request: PurchaseRequest, db = Depends(get_db)):
         db.add(transaction)
         
         # 取引明細データ作成
+        details = []
         for i, item in enumerate(request.cart_items, 1):
             detail = TransactionDetail(
                 detail_id=f"{transaction_id}_{i:03d}",
@@ -268,23 +510,135 @@ def purchase(request: PurchaseRequest, db = Depends(get_db)):
                 subtotal_incl_tax=item.subtotal_incl_tax
             )
             db.add(detail)
+            details.append(detail)
+        
+        # 適用プロモーション記録
+        transaction_promotions = [
+            TransactionPromotion(
+                transaction_id=transaction_id,
+                promotion_id=applied["promotion_id"],
+                promotion_name=applied["promotion_name"],
+                applied_count=applied["applied_count"],
+                discount_amount=applied["discount_amount"]
+            ) for applied in applied_promotions
+        ]
+        db.add_all(transaction_promotions)
+        
+        # 在庫減算（バーコード単位に集約し、バーコード順に1回でUPDATE）
+        # バッチ反映モードでは減算待ちとして同じトランザクションで記録し、バッチャーがまとめて反映
+        stock_items = [(item.barcode, item.quantity) for item in request.cart_items]
+        if inventory_batcher is None:
+            decrement_stock(db, request.store_code, stock_items)
+        else:
+            enqueue_decrements(db, request.store_code, stock_items)
+        
+        # レシート再発行用（コミット後は属性が失効するため先に作成）
+        receipt = build_transaction_response(transaction, details, transaction_promotions)
         
         # コミット
         db.commit()
         
+        receipt_cache.put(request.store_code, request.pos_machine_id, transaction_id, receipt)
+        
         return PurchaseResponse(
             success=True,
             message="購入が完了しました",
             transaction_id=transaction_id,
             total_amount_excl_tax=total_amount_excl_tax,
             total_tax_amount=total_tax_amount,
-            total_amount_incl_tax=total_amount_incl_tax
+            total_amount_incl_tax=total_amount_incl_tax,
+            total_discount_amount=total_discount_amount,
+            applied_promotions=applied_promotions
         )
         
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=f"購入処理エラー: {str(e)}")
 
+@app.get("/api/transactions/{transaction_id}", response_model=TransactionResponse)
+def get_transaction(transaction_id: str, db = Depends(get_db)):
+    """
+    取引照会（レシート再発行・返品・監査用）
+    """
+    try:
+        cached = receipt_cache.get(transaction_id)
+        if cached is not None:
+            return cached
+        
+        result = load_transaction(db, transaction_id)
+        if result is None:
+            raise HTTPException(status_code=404, detail="取引が見つかりません")
+        return build_transaction_response(*result)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"取引照会エラー: {str(e)}")
+
+@app.get("/api/terminals/{store_code}/{pos_machine_id}/transactions", response_model=TransactionListResponse)
+def get_recent_transactions(
+    store_code: str,
+    pos_machine_id: str,
+    limit: int = Query(20, ge=1, le=100),
+    before: Optional[str] = None,
+    db = Depends(get_db)
+):
+    """
+    端末の直近取引一覧（新しい順、next_cursor を before に渡して次ページ取得）
+    """
+    try:
+        transactions, next_cursor = load_recent_transactions(db, store_code, pos_machine_id, limit, before)
+        return TransactionListResponse(
+            count=len(transactions),
+            transactions=[build_transaction_response(h, d, p) for h, d, p in transactions],
+            next_cursor=next_cursor
+        )
+    except ValueError:
+        raise HTTPException(status_code=400, detail="カーソルが不正です")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"取引照会エラー: {str(e)}")
+
+@app.get("/api/inventory/low-stock", response_model=LowStockResponse)
+def low_stock(
+    store_code: str,
+    limit: int = Query(100, ge=1, le=1000),
+    db = Depends(get_db)
+):
+    """
+    在庫僅少商品一覧（発注点以下）
+    """
+    try:
+        rows = get_low_stock(db, store_code, limit)
+        return LowStockResponse(
+            store_code=store_code,
+            count=len(rows),
+            items=[
+                LowStockItem(barcode=r.barcode, quantity=r.quantity, reorder_point=r.reorder_point)
+                for r in rows
+            ]
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"在庫照会エラー: {str(e)}")
+
+@app.get("/api/price-events")
+async def price_events(
+    request: Request,
+    since: Optional[int] = Query(None, ge=0),
+    last_event_id: Optional[str] = Header(None)
+):
+    """
+    価格変更通知（Server-Sent Events、商品・税マスタは全店舗共通のため全端末に同じ変更を配信）
+    再接続時は Last-Event-ID ヘッダーまたは since の version から再開
+    """
+    cursor = since
+    if last_event_id and last_event_id.isdigit():
+        cursor = int(last_event_id)
+    return StreamingResponse(
+        price_event_broadcaster.stream(cursor, request.is_disconnected),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.get("/api/health")
 def health_check():
     """
@@ -333,6 +687,25 @@ def debug_products(db = Depends(get_db)):
     except Exception as e:
         return {"error": str(e)}
 
+@app.get("/api/debug/profiles", dependencies=[Depends(require_profile_admin)])
+def debug_profiles():
+    """
+    デバッグ用: 保存済みプロファイル一覧（新しい順）
+    """
+    captures = list_captures()
+    return {"count": len(captures), "profiles": captures}
+
+@app.get("/api/debug/profiles/{capture_id}", dependencies=[Depends(require_profile_admin)])
+def debug_profile_download(capture_id: str, format: str = Query("json", pattern="^(json|prof)$")):
+    """
+    デバッグ用: プロファイルのダウンロード（json: SQL一覧とプロファイル要約, prof: pstats形式）
+    """
+    path = capture_path(capture_id, f".{format}")
+    if path is None:
+        raise HTTPException(status_code=404, detail="プロファイルが見つかりません")
+    media_type = "application/json" if format == "json" else "application/octet-stream"
+    return FileResponse(path, media_type=media_type, filename=path.name)
+
 # Azureでの起動設定（デバッグ用）
 if __name__ == "__main__":
     import uvicorn
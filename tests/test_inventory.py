@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+在庫引当のテスト（バッチャーは一時SQLiteで確認）
+"""
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from db_control import inventory
+from db_control.inventory import InventoryBatcher, aggregate_quantities, enqueue_decrements
+from db_control.mymodels_MySQL import Base, InventoryData, InventoryPendingDecrement
+
+
+def test_aggregate_quantities_sorted_by_barcode():
+    items = [("300", 1), ("100", 2), ("200", 1), ("100", 3), ("300", 4)]
+    assert aggregate_quantities(items) == [("100", 5), ("200", 1), ("300", 5)]
+
+
+def test_aggregate_quantities_drops_zero_totals():
+    assert aggregate_quantities([("100", 2), ("100", -2), ("200", 0)]) == []
+
+
+def test_aggregate_quantities_empty():
+    assert aggregate_quantities([]) == []
+
+
+@pytest.fixture
+def Session(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'inventory.db'}")
+    Base.metadata.create_all(engine, tables=[InventoryData.__table__, InventoryPendingDecrement.__table__])
+    factory = sessionmaker(bind=engine)
+    with factory() as db:
+        db.add_all([
+            InventoryData(store_code="30", barcode="100", quantity=50, reorder_point=0),
+            InventoryData(store_code="30", barcode="200", quantity=50, reorder_point=0),
+        ])
+        db.commit()
+    yield factory
+    engine.dispose()
+
+
+def purchase(Session, items):
+    with Session() as db:
+        enqueue_decrements(db, "30", items)
+        db.commit()
+
+
+def stock(Session):
+    with Session() as db:
+        return {row.barcode: row.quantity for row in db.query(InventoryData).all()}
+
+
+def pending_count(Session):
+    with Session() as db:
+        return db.query(InventoryPendingDecrement).count()
+
+
+def test_flush_applies_pending_and_clears_queue(Session):
+    purchase(Session, [("100", 2), ("200", 1), ("100", 1)])
+    purchase(Session, [("200", 4)])
+    assert pending_count(Session) == 3
+
+    assert InventoryBatcher(Session, 1).flush() == 3
+    assert stock(Session) == {"100": 47, "200": 45}
+    assert pending_count(Session) == 0
+
+
+def test_rolled_back_purchase_leaves_no_pending(Session):
+    with Session() as db:
+        enqueue_decrements(db, "30", [("100", 5)])
+        db.rollback()
+    assert pending_count(Session) == 0
+
+
+def test_failed_flush_keeps_pending_for_next_flush(Session, monkeypatch):
+    purchase(Session, [("100", 2), ("200", 3)])
+    batcher = InventoryBatcher(Session, 1)
+
+    original = inventory._execute_decrements
+
+    def fail_after_update(db, rows):
+        original(db, rows)
+        raise RuntimeError("lock wait timeout")
+
+    monkeypatch.setattr(inventory, "_execute_decrements", fail_after_update)
+    assert batcher.flush() == 0
+    # 失敗した反映はロールバックされ、減算待ちは残る
+    assert stock(Session) == {"100": 50, "200": 50}
+    assert pending_count(Session) == 2
+
+    monkeypatch.setattr(inventory, "_execute_decrements", original)
+    purchase(Session, [("100", 1)])
+    assert batcher.flush() == 3
+    assert stock(Session) == {"100": 47, "200": 47}
+    assert pending_count(Session) == 0
+
+
+def test_drain_processes_more_than_one_batch(Session, monkeypatch):
+    monkeypatch.setattr(inventory, "FLUSH_LIMIT", 2)
+    for _ in range(5):
+        purchase(Session, [("100", 1)])
+    InventoryBatcher(Session, 1).drain()
+    assert stock(Session)["100"] == 45
+    assert pending_count(Session) == 0
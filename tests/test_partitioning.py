@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+取引パーティション補助関数のテスト（DB不要）
+"""
+
+from datetime import datetime
+
+from db_control import partitioning
+from db_control.partitioning import (
+    current_transaction_datetime, generate_transaction_id, transaction_datetime_range, transaction_id_bounds
+)
+
+
+def test_month_range_bounds():
+    assert transaction_id_bounds(datetime(2026, 9, 1), datetime(2026, 10, 1)) == ("20260901", "20261001")
+
+
+def test_end_with_time_includes_that_day():
+    assert transaction_id_bounds(datetime(2026, 9, 30, 8), datetime(2026, 9, 30, 12, 30)) == ("20260930", "20261001")
+
+
+def test_open_ended():
+    assert transaction_id_bounds(start=datetime(2026, 1, 1)) == ("20260101", None)
+    assert transaction_id_bounds(end=datetime(2026, 1, 1)) == (None, "20260101")
+
+
+def test_bounds_contain_transaction_ids_of_the_range():
+    lower, upper = transaction_id_bounds(datetime(2026, 9, 1), datetime(2026, 9, 30, 23, 59))
+    assert lower <= "20260901_30_90_000000" < upper
+    assert lower <= "20260930_30_90_235800" < upper
+    assert not ("20261001_30_90_000000" < upper)
+
+
+def test_datetime_range_adds_id_conditions():
+    conditions = transaction_datetime_range(datetime(2026, 9, 1), datetime(2026, 10, 1))
+    compiled = [str(c.compile(compile_kwargs={"literal_binds": True})) for c in conditions]
+    assert "transaction_data.transaction_id >= '20260901'" in compiled
+    assert "transaction_data.transaction_id < '20261001'" in compiled
+    assert len(compiled) == 4
+
+
+class _JustBeforeMidnight(datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return cls(2026, 10, 19, 23, 59, 59, 600000)
+
+
+def test_transaction_datetime_at_midnight_boundary(monkeypatch):
+    monkeypatch.setattr(partitioning, "datetime", _JustBeforeMidnight)
+    now = current_transaction_datetime()
+    # 小数秒を切り捨て、DATETIME への保存時に翌日へ繰り上がらない
+    assert now == datetime(2026, 10, 19, 23, 59, 59)
+    assert now.microsecond == 0
+
+    transaction_id = generate_transaction_id("30", "90", now)
+    assert transaction_id == "20261019_30_90_235959"
+    lower, upper = transaction_id_bounds(datetime(2026, 10, 19), datetime(2026, 10, 20))
+    assert lower <= transaction_id < upper
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+価格変更履歴の記録と価格変更通知のテスト（一時SQLite）
+"""
+
+import asyncio
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from db_control.mymodels_MySQL import Base, PriceChangeLog, PriceChangeVersion, ProductMaster, TaxMaster
+from db_control import price_events
+from db_control.price_events import PriceEventBroadcaster, _fetch_after
+
+
+@pytest.fixture
+def Session(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'price.db'}")
+    Base.metadata.create_all(engine)
+    factory = sessionmaker(bind=engine)
+    yield factory
+    engine.dispose()
+
+
+def logs(Session):
+    with Session() as db:
+        return [
+            (log.version, log.change_type, log.barcode, log.unit_price, log.is_active)
+            for log in db.query(PriceChangeLog).order_by(PriceChangeLog.version)
+        ]
+
+
+class TestRecordPriceChanges:
+    def test_plain_session_records_versions_in_order(self, Session):
+        with Session() as db:
+            db.add(TaxMaster(tax_code="T10", tax_name="標準税率", tax_rate=0.1))
+            db.add(ProductMaster(barcode="1", product_name="ノート", unit_price=200, tax_code="T10"))
+            db.commit()
+        assert [row[0] for row in logs(Session)] == [1, 2]
+
+        with Session() as db:
+            product = db.get(ProductMaster, "1")
+            product.unit_price = 180
+            db.commit()
+        assert logs(Session)[-1] == (3, "product", "1", 180, 1)
+
+        with Session() as db:
+            assert db.get(PriceChangeVersion, 1).version == 3
+
+    def test_unrelated_change_is_not_recorded(self, Session):
+        with Session() as db:
+            db.add(TaxMaster(tax_code="T10", tax_name="標準税率", tax_rate=0.1))
+            db.commit()
+        with Session() as db:
+            db.get(TaxMaster, "T10").tax_name = "標準"
+            db.commit()
+        assert len(logs(Session)) == 1
+
+    def test_delete_is_recorded_as_inactive(self, Session):
+        with Session() as db:
+            db.add(TaxMaster(tax_code="T10", tax_name="標準税率", tax_rate=0.1))
+            db.add(ProductMaster(barcode="1", product_name="ノート", unit_price=200, tax_code="T10"))
+            db.commit()
+        with Session() as db:
+            db.delete(db.get(ProductMaster, "1"))
+            db.commit()
+        assert logs(Session)[-1] == (3, "product", "1", None, 0)
+
+    def test_rollback_discards_log_and_version(self, Session):
+        with Session() as db:
+            db.add(TaxMaster(tax_code="T10", tax_name="標準税率", tax_rate=0.1))
+            db.flush()
+            db.rollback()
+        assert logs(Session) == []
+        with Session() as db:
+            db.add(TaxMaster(tax_code="T08", tax_name="軽減税率", tax_rate=0.08))
+            db.commit()
+        assert [row[0] for row in logs(Session)] == [1]
+
+
+def add_products(Session, count):
+    with Session() as db:
+        if db.get(TaxMaster, "T10") is None:
+            db.add(TaxMaster(tax_code="T10", tax_name="標準税率", tax_rate=0.1))
+        start = db.query(ProductMaster).count()
+        for i in range(start, start + count):
+            db.add(ProductMaster(barcode=str(i), product_name=f"商品{i}", unit_price=100 + i, tax_code="T10"))
+        db.commit()
+
+
+def collect(broadcaster, cursor, count, background=None):
+    """
+    stream() から hello を除くメッセージを count 件受け取る（keepaliveは除く）
+    background: 受信中に並行して実行するコルーチン関数（ポーリングによる配信の代わり）
+    """
+    async def run():
+        messages = []
+        task = asyncio.create_task(background()) if background is not None else None
+
+        async def is_disconnected():
+            return False
+
+        async for message in broadcaster.stream(cursor, is_disconnected):
+            if message.startswith(":") or "event: hello" in message:
+                continue
+            messages.append(message)
+            if len(messages) >= count:
+                break
+        if task is not None:
+            await task
+        return messages
+
+    return asyncio.run(asyncio.wait_for(run(), 5))
+
+
+def event_ids(messages):
+    return [int(m.split("\n", 1)[0][len("id: "):]) for m in messages]
+
+
+class TestEventsAfter:
+    def make(self, monkeypatch, size, versions):
+        monkeypatch.setattr(price_events, "BUFFER_SIZE", size)
+        broadcaster = PriceEventBroadcaster(None)
+        broadcaster.version = versions[0] - 1
+        broadcaster.publish([(v, f"m{v}") for v in versions])
+        return broadcaster
+
+    def test_resume_from_buffer(self, monkeypatch):
+        broadcaster = self.make(monkeypatch, 10, [1, 2, 3])
+        assert broadcaster._events_after(1) == [(2, "m2"), (3, "m3")]
+        assert broadcaster._events_after(0) == [(1, "m1"), (2, "m2"), (3, "m3")]
+
+    def test_up_to_date_cursor(self, monkeypatch):
+        broadcaster = self.make(monkeypatch, 10, [1, 2, 3])
+        assert broadcaster._events_after(3) == []
+
+    def test_cursor_older_than_buffer(self, monkeypatch):
+        broadcaster = self.make(monkeypatch, 3, [1, 2, 3, 4, 5])
+        assert broadcaster._events_after(1) is None
+        assert broadcaster._events_after(2) == [(3, "m3"), (4, "m4"), (5, "m5")]
+
+
+class TestStream:
+    def test_resume_from_buffer(self, Session):
+        add_products(Session, 4)  # version 5
+        broadcaster = PriceEventBroadcaster(Session)
+        broadcaster.version = 0
+        broadcaster.publish(_fetch_after(Session, 0, 100))
+        messages = collect(broadcaster, 3, 2)
+        assert event_ids(messages) == [4, 5]
+        assert all("event: price" in m for m in messages)
+
+    def test_falls_back_to_log_table_outside_buffer(self, Session):
+        add_products(Session, 4)  # version 5
+        # version 3 で起動したワーカーのバッファには 4, 5 しかない
+        broadcaster = PriceEventBroadcaster(Session)
+        broadcaster.version = 3
+        broadcaster.publish(_fetch_after(Session, 3, 100))
+        messages = collect(broadcaster, 1, 4)
+        assert event_ids(messages) == [2, 3, 4, 5]
+
+    def test_cursor_too_old_is_reset(self, Session, monkeypatch):
+        monkeypatch.setattr(price_events, "BUFFER_SIZE", 2)
+        add_products(Session, 5)  # version 6
+        broadcaster = PriceEventBroadcaster(Session)
+        broadcaster.version = 0
+        broadcaster.publish(_fetch_after(Session, 0, 100))
+        messages = collect(broadcaster, 1, 1)
+        assert "event: reset" in messages[0]
+        assert event_ids(messages) == [6]
+
+    def test_new_cursor_starts_at_latest(self, Session):
+        add_products(Session, 1)  # version 2
+        broadcaster = PriceEventBroadcaster(Session)
+        broadcaster.version = 0
+        broadcaster.publish(_fetch_after(Session, 0, 100))
+
+        async def change_later():
+            await asyncio.sleep(0.1)
+            add_products(Session, 1)
+            broadcaster.publish(_fetch_after(Session, 2, 100))
+
+        messages = collect(broadcaster, None, 1, background=change_later)
+        assert event_ids(messages) == [3]
+        assert '"unit_price":101' in messages[0]
+
+    def test_cursor_ahead_of_server_is_reset(self, Session):
+        add_products(Session, 2)  # T10 + 2商品 → version 3
+        broadcaster = PriceEventBroadcaster(Session)
+        broadcaster.version = 3
+        messages = collect(broadcaster, 10, 1)
+        assert "event: reset" in messages[0]
+        assert event_ids(messages) == [3]
+
+    def test_cursor_ahead_of_lagging_worker_is_not_reset(self, Session):
+        add_products(Session, 3)  # version 4
+        broadcaster = PriceEventBroadcaster(Session)
+        broadcaster.publish(_fetch_after(Session, 0, 2))  # このワーカーは version 2 まで取り込み済み
+
+        async def poll_later():
+            await asyncio.sleep(0.1)
+            broadcaster.publish(_fetch_after(Session, 2, 100))
+
+        # 他のワーカーから version 3 を受け取った端末が再接続
+        messages = collect(broadcaster, 3, 1, background=poll_later)
+        assert "event: price" in messages[0]
+        assert event_ids(messages) == [4]
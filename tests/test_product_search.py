@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+商品名検索インデックスのテスト（変更履歴の取り込みは一時SQLite）
+"""
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from db_control.mymodels_MySQL import Base, ProductMaster, TaxMaster
+from db_control.product_search import ProductSearchIndex, normalize_name
+
+
+class FakeQuery:
+    """
+    db.query(...).filter(...).all() の代わりに固定の行を返す（読み込み中の処理を差し込める）
+    """
+
+    def __init__(self, rows, during_load=None):
+        self._rows = rows
+        self._during_load = during_load
+
+    def query(self, *columns):
+        return self
+
+    def filter(self, *conditions):
+        return self
+
+    def all(self):
+        if self._during_load is not None:
+            self._during_load()
+        return list(self._rows)
+
+    def scalar(self):
+        return 0
+
+
+def build_index(products):
+    index = ProductSearchIndex()
+    index.load(FakeQuery(products))
+    return index
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("ボールペン", "ぼーるぺん"),
+    ("ﾎﾞｰﾙﾍﾟﾝ", "ぼーるぺん"),
+    ("ＡＢＣ", "abc"),
+    ("Abc", "abc"),
+    ("ノート A4", "のーとa4"),
+    ("  消しゴム　大 ", "消しごむ大"),
+    ("ヴ", "ゔ"),
+    ("", ""),
+    (None, ""),
+])
+def test_normalize_name(text, expected):
+    assert normalize_name(text) == expected
+
+
+class TestSearch:
+    def test_full_and_half_width_and_kana_match(self):
+        index = build_index([("1", "ボールペン 青"), ("2", "ノート A4")])
+        assert index.search("ぼーるぺん") == ["1"]
+        assert index.search("ﾎﾞｰﾙﾍﾟﾝ") == ["1"]
+        assert index.search("ａ４") == ["2"]
+
+    def test_ranking_exact_prefix_substring(self):
+        index = build_index([
+            ("substring", "赤ボールペン"),
+            ("prefix_long", "ボールペン 青 替芯付き"),
+            ("prefix_short", "ボールペン 青"),
+            ("exact", "ボールペン"),
+            ("later", "多色 ボールペン"),
+        ])
+        assert index.search("ボールペン") == ["exact", "prefix_short", "prefix_long", "substring", "later"]
+
+    def test_limit(self):
+        index = build_index([(str(i), f"ノート{i}") for i in range(10)])
+        assert len(index.search("ノート", limit=3)) == 3
+        assert index.search("ノート", limit=0) == []
+
+    def test_all_grams_must_match(self):
+        index = build_index([("1", "のりとはさみ")])
+        assert index.search("のはさ") == []
+
+    def test_single_character_is_prefix_only(self):
+        index = build_index([("1", "のり"), ("2", "ノート"), ("3", "ボールペン"), ("4", "の")])
+        assert index.search("の") == ["4", "1", "2"]
+        assert index.search("ル") == []
+
+    def test_update_and_deactivate(self):
+        index = build_index([("1", "ノート"), ("2", "のり")])
+        index.upsert("1", "ファイル")
+        assert index.search("ノート") == []
+        assert index.search("ファイル") == ["1"]
+        index.upsert("2", "のり", is_active=0)
+        assert index.search("のり") == []
+        assert len(index) == 1
+
+
+class TestChangesDuringLoad:
+    def test_changes_committed_while_loading_are_replayed(self):
+        index = ProductSearchIndex()
+
+        def commit_during_load():
+            index.apply_changes({"new": ("消しゴム", 1), "old": None})
+
+        index.load(FakeQuery([("old", "えんぴつ")], during_load=commit_during_load))
+        assert index.search("消しゴム") == ["new"]
+        assert index.search("えんぴつ") == []
+
+    def test_changes_before_load_are_ignored(self):
+        index = ProductSearchIndex()
+        index.apply_changes({"1": ("ノート", 1)})
+        index.load(FakeQuery([]))
+        assert index.search("ノート") == []
+
+    def test_failed_load_discards_backlog(self):
+        index = ProductSearchIndex()
+
+        def fail():
+            index.apply_changes({"1": ("ノート", 1)})
+            raise RuntimeError("db down")
+
+        with pytest.raises(RuntimeError):
+            index.load(FakeQuery([], during_load=fail))
+        assert not index.loaded
+        index.load(FakeQuery([]))
+        assert index.search("ノート") == []
+
+
+@pytest.fixture
+def Session(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'products.db'}")
+    Base.metadata.create_all(engine)
+    factory = sessionmaker(bind=engine)
+    with factory() as db:
+        db.add(TaxMaster(tax_code="T10", tax_name="標準税率", tax_rate=0.1))
+        db.add(ProductMaster(barcode="1", product_name="ノート A4", unit_price=200, tax_code="T10"))
+        db.add(ProductMaster(barcode="2", product_name="のり", unit_price=150, tax_code="T10"))
+        db.commit()
+    yield factory
+    engine.dispose()
+
+
+class TestChangeFeed:
+    """
+    他のワーカー・プロセスでコミットされた変更を price_change_log から取り込む
+    """
+
+    def test_refresh_applies_changes_from_other_processes(self, Session):
+        index = ProductSearchIndex()
+        with Session() as db:
+            index.load(db)
+        assert index.search("ノート") == ["1"]
+
+        # 別のセッション（別ワーカー相当）で追加・改名・無効化
+        with Session() as db:
+            db.add(ProductMaster(barcode="3", product_name="消しゴム", unit_price=80, tax_code="T10"))
+            db.get(ProductMaster, "1").product_name = "ファイル A4"
+            db.get(ProductMaster, "2").is_active = 0
+            db.commit()
+        assert index.search("消しゴム") == []
+
+        with Session() as db:
+            assert index.refresh(db) == 3
+        assert index.search("消しゴム") == ["3"]
+        assert index.search("ファイル") == ["1"]
+        assert index.search("ノート") == []
+        assert index.search("のり") == []
+
+    def test_refresh_applies_deletes_and_price_only_changes(self, Session):
+        index = ProductSearchIndex()
+        with Session() as db:
+            index.load(db)
+        with Session() as db:
+            db.get(ProductMaster, "1").unit_price = 180
+            db.delete(db.get(ProductMaster, "2"))
+            db.commit()
+        with Session() as db:
+            index.refresh(db)
+        assert index.search("ノート") == ["1"]
+        assert index.search("のり") == []
+
+    def test_changes_before_load_are_not_replayed(self, Session):
+        with Session() as db:
+            db.get(ProductMaster, "1").product_name = "ファイル"
+            db.commit()
+        index = ProductSearchIndex()
+        with Session() as db:
+            index.load(db)
+            assert index.refresh(db) == 0
+        assert index.search("ファイル") == ["1"]
+
+    def test_ensure_fresh_keeps_index_when_feed_fails(self, Session, monkeypatch):
+        index = ProductSearchIndex()
+        with Session() as db:
+            index.load(db)
+        monkeypatch.setattr("db_control.product_search.REFRESH_INTERVAL_SECONDS", 0)
+
+        def fail(db):
+            raise RuntimeError("db down")
+
+        monkeypatch.setattr(index, "refresh", fail)
+        with Session() as db:
+            index.ensure_fresh(db)
+        assert index.search("ノート") == ["1"]
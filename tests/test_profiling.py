@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""
+プロファイリングの強制計測の認証テスト
+"""
+
+import pytest
+
+from db_control.profiling import _bearer_token, is_profile_admin_token
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("Bearer secret", "secret"),
+    ("bearer secret", "secret"),
+    ("Basic secret", None),
+    ("", None),
+    (None, None),
+])
+def test_bearer_token(header, expected):
+    assert _bearer_token(header) == expected
+
+
+def test_admin_token_required(monkeypatch):
+    monkeypatch.setenv("PROFILE_ADMIN_TOKEN", "secret")
+    assert is_profile_admin_token("secret")
+    assert not is_profile_admin_token("wrong")
+    assert not is_profile_admin_token(None)
+
+
+def test_no_admin_token_configured(monkeypatch):
+    monkeypatch.delenv("PROFILE_ADMIN_TOKEN", raising=False)
+    assert not is_profile_admin_token("secret")
+    assert not is_profile_admin_token("")
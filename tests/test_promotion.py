@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+プロモーション適用エンジンのテスト（DB不要）
+"""
+
+from datetime import datetime, time, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+from db_control.promotion import (
+    BUNDLE, MULTI_BUY, TIME_DISCOUNT, PromotionEngine, _allocate, discounted_line_amounts
+)
+
+NOW = datetime(2026, 4, 1, 12, 0)
+
+
+def promotion(promotion_id, promotion_type, **fields):
+    values = {
+        "promotion_id": promotion_id,
+        "promotion_name": f"{promotion_id}の名称",
+        "promotion_type": promotion_type,
+        "required_quantity": None,
+        "promo_price": None,
+        "discount_rate": None,
+        "discount_amount": None,
+        "start_datetime": NOW - timedelta(days=1),
+        "end_datetime": None,
+        "daily_start_time": None,
+        "daily_end_time": None,
+        "priority": 100,
+    }
+    values.update(fields)
+    return SimpleNamespace(**values)
+
+
+def engine_with(promotions, items):
+    engine = PromotionEngine()
+    engine.compile(promotions, items)
+    return engine
+
+
+def applied_by_id(applied):
+    return {a["promotion_id"]: a for a in applied}
+
+
+class TestAllocate:
+    def test_proportional_split_sums_to_total(self):
+        assert _allocate(100, [100, 100]) == [50, 50]
+        assert sum(_allocate(101, [100, 100, 100])) == 101
+
+    def test_share_never_exceeds_weight(self):
+        shares = _allocate(6, [3, 3, 1])
+        assert sum(shares) == 6
+        assert all(share <= weight for share, weight in zip(shares, [3, 3, 1]))
+
+    def test_zero_weights(self):
+        assert _allocate(10, [0, 0]) == [0, 0]
+
+
+class TestBundle:
+    def test_counts_complete_sets_only(self):
+        engine = engine_with(
+            [promotion("B1", BUNDLE, promo_price=250)],
+            [("B1", "onigiri", 1), ("B1", "tea", 1)]
+        )
+        # おにぎり3個・お茶2本 → 2セット
+        discounts, applied = engine.apply([("onigiri", 150, 3), ("tea", 140, 2)], NOW)
+        assert applied_by_id(applied)["B1"]["applied_count"] == 2
+        # (150 + 140 - 250) * 2 = 80
+        assert sum(discounts) == 80
+        assert applied_by_id(applied)["B1"]["discount_amount"] == 80
+
+    def test_component_quantity(self):
+        engine = engine_with(
+            [promotion("B1", BUNDLE, promo_price=300)],
+            [("B1", "bread", 2), ("B1", "milk", 1)]
+        )
+        discounts, applied = engine.apply([("bread", 120, 3), ("milk", 100, 1)], NOW)
+        assert applied_by_id(applied)["B1"]["applied_count"] == 1
+        assert sum(discounts) == 120 * 2 + 100 - 300
+
+    def test_no_discount_when_set_price_is_not_cheaper(self):
+        engine = engine_with(
+            [promotion("B1", BUNDLE, promo_price=500)],
+            [("B1", "a", 1), ("B1", "b", 1)]
+        )
+        discounts, applied = engine.apply([("a", 100, 1), ("b", 100, 1)], NOW)
+        assert discounts == [0, 0]
+        assert applied == []
+
+
+class TestMultiBuy:
+    def test_counts_sets_across_mixed_items(self):
+        engine = engine_with(
+            [promotion("M1", MULTI_BUY, required_quantity=3, promo_price=250)],
+            [("M1", "a", 1), ("M1", "b", 1), ("M1", "c", 1)]
+        )
+        # 7点 → 2セット（6点）、最も安い1点は対象外
+        discounts, applied = engine.apply([("a", 100, 3), ("b", 120, 2), ("c", 90, 2)], NOW)
+        assert applied_by_id(applied)["M1"]["applied_count"] == 2
+        # 高い順に b,b,a,a,a,c → 240 + 300 + 90 - 500 = 130
+        assert sum(discounts) == 130
+
+    def test_same_barcode_at_different_prices_uses_each_line_price(self):
+        engine = engine_with(
+            [promotion("M1", MULTI_BUY, required_quantity=2, promo_price=150)],
+            [("M1", "x", 1)]
+        )
+        discounts, applied = engine.apply([("x", 100, 1), ("x", 120, 1), ("x", 10, 1)], NOW)
+        # 高い2点（120 + 100）が1セット、10円の明細は対象外
+        assert discounts[2] == 0
+        assert discounts[0] + discounts[1] == 70
+        assert applied_by_id(applied)["M1"]["discount_amount"] == 70
+
+
+class TestTimeDiscount:
+    def test_discount_amount_per_line_price(self):
+        engine = engine_with(
+            [promotion("T1", TIME_DISCOUNT, discount_amount=90)],
+            [("T1", "x", 1)]
+        )
+        discounts, applied = engine.apply([("x", 100, 1), ("x", 10, 1)], NOW)
+        assert discounts == [90, 10]
+        assert applied_by_id(applied)["T1"]["discount_amount"] == 100
+
+    def test_discount_rate(self):
+        engine = engine_with(
+            [promotion("T1", TIME_DISCOUNT, discount_rate=0.3)],
+            [("T1", "x", 1)]
+        )
+        discounts, _ = engine.apply([("x", 155, 2)], NOW)
+        assert discounts == [int(155 * 0.3) * 2]
+
+    @pytest.mark.parametrize("current, expected", [
+        (time(23, 30), True),
+        (time(1, 59), True),
+        (time(2, 0), False),
+        (time(12, 0), False),
+    ])
+    def test_overnight_daily_window(self, current, expected):
+        engine = engine_with(
+            [promotion("T1", TIME_DISCOUNT, discount_amount=10,
+                       daily_start_time=time(22, 0), daily_end_time=time(2, 0))],
+            [("T1", "x", 1)]
+        )
+        now = datetime.combine(NOW.date(), current)
+        discounts, applied = engine.apply([("x", 100, 1)], now)
+        assert bool(applied) is expected
+        assert discounts == [10 if expected else 0]
+
+    def test_expired_at_end_datetime(self):
+        engine = engine_with(
+            [promotion("T1", TIME_DISCOUNT, discount_amount=10, end_datetime=NOW)],
+            [("T1", "x", 1)]
+        )
+        assert engine.apply([("x", 100, 1)], NOW - timedelta(seconds=1))[0] == [10]
+        assert engine.apply([("x", 100, 1)], NOW) == ([0], [])
+
+    def test_not_started(self):
+        engine = engine_with(
+            [promotion("T1", TIME_DISCOUNT, discount_amount=10, start_datetime=NOW + timedelta(hours=1))],
+            [("T1", "x", 1)]
+        )
+        assert engine.apply([("x", 100, 1)], NOW) == ([0], [])
+
+
+class TestPriority:
+    def test_higher_priority_consumes_items_first(self):
+        engine = engine_with(
+            [
+                promotion("B1", BUNDLE, promo_price=200, priority=1),
+                promotion("M1", MULTI_BUY, required_quantity=2, promo_price=150, priority=2),
+            ],
+            [("B1", "a", 1), ("B1", "b", 1), ("M1", "a", 1)]
+        )
+        # a×3, b×1 → セットが a1+b1 を消費し、残りの a×2 がまとめ買い
+        discounts, applied = engine.apply([("a", 100, 3), ("b", 150, 1)], NOW)
+        result = applied_by_id(applied)
+        assert result["B1"]["applied_count"] == 1
+        assert result["B1"]["discount_amount"] == 50
+        assert result["M1"]["applied_count"] == 1
+        assert result["M1"]["discount_amount"] == 50
+        assert sum(discounts) == 100
+
+    def test_consumed_items_are_not_discounted_twice(self):
+        engine = engine_with(
+            [
+                promotion("M1", MULTI_BUY, required_quantity=2, promo_price=150, priority=1),
+                promotion("T1", TIME_DISCOUNT, discount_amount=30, priority=2),
+            ],
+            [("M1", "a", 1), ("T1", "a", 1)]
+        )
+        discounts, applied = engine.apply([("a", 100, 3)], NOW)
+        result = applied_by_id(applied)
+        assert result["M1"]["applied_count"] == 1
+        assert result["T1"]["applied_count"] == 1
+        assert discounts == [50 + 30]
+
+
+class TestLineDiscountInvariants:
+    def test_line_discount_never_exceeds_line_amount(self):
+        engine = engine_with(
+            [
+                promotion("M1", MULTI_BUY, required_quantity=3, promo_price=1, priority=1),
+                promotion("T1", TIME_DISCOUNT, discount_amount=1000, priority=2),
+            ],
+            [("M1", "x", 1), ("M1", "y", 1), ("T1", "x", 1), ("T1", "y", 1)]
+        )
+        lines = [("x", 3, 1), ("y", 3, 1), ("x", 1, 2), ("y", 7, 1)]
+        discounts, applied = engine.apply(lines, NOW)
+        for (_, price, quantity), discount in zip(lines, discounts):
+            assert 0 <= discount <= price * quantity
+        assert sum(discounts) == sum(a["discount_amount"] for a in applied)
+
+
+class TestDiscountedLineAmounts:
+    def test_recomputes_tax_on_discounted_subtotal(self):
+        # 150円×3個から80円値引 → 税抜370円、税額は切り捨て
+        assert discounted_line_amounts(150, 3, 80, 0.08) == (370, 29, 399)
+
+    def test_no_discount(self):
+        assert discounted_line_amounts(100, 2, 0, 0.10) == (200, 20, 220)
+
+
+class FailingSession:
+    def __init__(self):
+        self.queries = 0
+        self.rolled_back = 0
+
+    def query(self, *entities):
+        self.queries += 1
+        raise RuntimeError("db down")
+
+    def rollback(self):
+        self.rolled_back += 1
+
+
+class TestEnsureFresh:
+    def test_failed_load_keeps_previous_index(self, monkeypatch):
+        engine = engine_with([promotion("T1", TIME_DISCOUNT, discount_amount=10)], [("T1", "x", 1)])
+        monkeypatch.setattr("db_control.promotion.REFRESH_INTERVAL_SECONDS", 0)
+        db = FailingSession()
+        engine.ensure_fresh(db)
+        assert db.rolled_back == 1
+        assert [p["promotion_id"] for p in engine.promotions_for("x", NOW)] == ["T1"]
+
+    def test_failed_first_load_is_not_retried_every_request(self):
+        engine = PromotionEngine()
+        db = FailingSession()
+        engine.ensure_fresh(db)
+        engine.ensure_fresh(db)
+        assert db.queries == 1
+        assert engine.promotions_for("x", NOW) == []
+        assert engine.apply([("x", 100, 1)], NOW) == ([0], [])
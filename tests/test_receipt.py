@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+取引照会（レシート再発行）のテスト（一時SQLite）
+"""
+
+import os
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from db_control.mymodels_MySQL import (
+    Base, CashierMaster, ProductMaster, PromotionItem, PromotionMaster, TaxMaster,
+    TransactionData, TransactionDetail, TransactionPromotion
+)
+from db_control.promotion import PromotionEngine
+from db_control.receipt import ReceiptCache, decode_cursor, load_recent_transactions, load_transaction
+
+
+class TestReceiptCache:
+    def test_evicts_oldest_per_terminal(self):
+        cache = ReceiptCache(per_terminal=2)
+        for tid in ("t1", "t2", "t3"):
+            cache.put("30", "90", tid, tid.upper())
+        assert cache.get("t1") is None
+        assert cache.get("t2") == "T2"
+        assert cache.get("t3") == "T3"
+
+    def test_terminals_are_independent(self):
+        cache = ReceiptCache(per_terminal=1)
+        cache.put("30", "90", "a1", "A1")
+        cache.put("30", "91", "b1", "B1")
+        assert cache.get("a1") == "A1"
+        assert cache.get("b1") == "B1"
+
+    def test_evicts_least_recently_used_terminal(self):
+        cache = ReceiptCache(per_terminal=5, max_terminals=2)
+        cache.put("30", "90", "a1", "A1")
+        cache.put("30", "91", "b1", "B1")
+        cache.get("a1")  # 端末90を最近使用に
+        cache.put("30", "92", "c1", "C1")
+        assert cache.get("b1") is None
+        assert cache.get("a1") == "A1"
+        assert cache.get("c1") == "C1"
+
+    def test_disabled(self):
+        cache = ReceiptCache(per_terminal=0)
+        cache.put("30", "90", "t1", "T1")
+        assert cache.get("t1") is None
+
+
+@pytest.mark.parametrize("cursor", ["", "abc", "not-a-date|20261019_30_90_100000", "2026-13-01T00:00:00|x"])
+def test_decode_cursor_rejects_bad_input(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)
+
+
+def test_decode_cursor():
+    assert decode_cursor("2026-10-19T10:00:00|20261019_30_90_100000") == (
+        datetime(2026, 10, 19, 10), "20261019_30_90_100000"
+    )
+
+
+@pytest.fixture
+def Session(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'receipt.db'}")
+    Base.metadata.create_all(engine)
+    factory = sessionmaker(bind=engine)
+    with factory() as db:
+        db.add(CashierMaster(cashier_code="CASHIER001", cashier_name="田中太郎", password_hash="x"))
+        db.commit()
+    yield factory
+    engine.dispose()
+
+
+def add_transaction(db, transaction_id, transaction_datetime, pos_machine_id="90", lines=1):
+    db.add(TransactionData(
+        transaction_id=transaction_id, store_code="30", pos_machine_id=pos_machine_id,
+        cashier_code="CASHIER001", transaction_datetime=transaction_datetime,
+        total_amount_excl_tax=100 * lines, total_tax_amount=10 * lines, total_amount_incl_tax=110 * lines
+    ))
+    for i in range(1, lines + 1):
+        db.add(TransactionDetail(
+            detail_id=f"{transaction_id}_{i:03d}", transaction_id=transaction_id, barcode="1",
+            product_name="ノート", unit_price=100, quantity=1, subtotal_excl_tax=100, tax_code="T10",
+            tax_rate=0.1, tax_amount=10, subtotal_incl_tax=110
+        ))
+
+
+class TestLoad:
+    def test_load_transaction_with_details(self, Session):
+        with Session() as db:
+            add_transaction(db, "20261019_30_90_100000", datetime(2026, 10, 19, 10), lines=3)
+            # 取引IDが前方一致する別取引の明細が混ざらない
+            add_transaction(db, "20261019_30_90_1000001", datetime(2026, 10, 19, 10), lines=1)
+            db.commit()
+            header, details, promotions = load_transaction(db, "20261019_30_90_100000")
+            assert header.total_amount_incl_tax == 330
+            assert promotions == []
+            assert [d.detail_id for d in details] == [
+                "20261019_30_90_100000_001", "20261019_30_90_100000_002", "20261019_30_90_100000_003"
+            ]
+            assert load_transaction(db, "missing") is None
+
+    def test_loads_applied_promotions(self, Session):
+        with Session() as db:
+            db.add(PromotionMaster(promotion_id="PR001", promotion_name="2点で180円", promotion_type="MULTI_BUY",
+                                   required_quantity=2, promo_price=180, start_datetime=datetime(2024, 1, 1)))
+            add_transaction(db, "20261019_30_90_100000", datetime(2026, 10, 19, 10), lines=2)
+            add_transaction(db, "20261019_30_90_110000", datetime(2026, 10, 19, 11))
+            db.add(TransactionPromotion(transaction_id="20261019_30_90_100000", promotion_id="PR001",
+                                        promotion_name="2点で180円", applied_count=1, discount_amount=20))
+            db.commit()
+            _, _, promotions = load_transaction(db, "20261019_30_90_100000")
+            assert [(p.promotion_id, p.discount_amount) for p in promotions] == [("PR001", 20)]
+            page, _ = load_recent_transactions(db, "30", "90", 10)
+            assert [len(p) for _, _, p in page] == [0, 1]
+
+    def test_keyset_paging_with_tied_datetimes(self, Session):
+        same = datetime(2026, 10, 19, 10)
+        with Session() as db:
+            # 同じ取引日時の取引が複数あり、ページ境界をまたぐ
+            for suffix in "abcde":
+                add_transaction(db, f"20261019_30_90_100000{suffix}", same)
+            add_transaction(db, "20261019_30_90_110000", same + timedelta(hours=1))
+            add_transaction(db, "20261018_30_90_100000", same - timedelta(days=1))
+            add_transaction(db, "20261019_30_91_100000", same, pos_machine_id="91")  # 別端末
+            db.commit()
+
+            seen = []
+            cursor = None
+            while True:
+                page, cursor = load_recent_transactions(db, "30", "90", 2, cursor)
+                seen.extend(header.transaction_id for header, _, _ in page)
+                assert all(len(details) == 1 for _, details, _ in page)
+                if cursor is None:
+                    break
+
+        assert seen == [
+            "20261019_30_90_110000",
+            "20261019_30_90_100000e", "20261019_30_90_100000d", "20261019_30_90_100000c",
+            "20261019_30_90_100000b", "20261019_30_90_100000a",
+            "20261018_30_90_100000",
+        ]
+
+
+@pytest.fixture
+def client(Session, monkeypatch):
+    monkeypatch.setenv("DATABASE_URL", os.getenv("DATABASE_URL") or "sqlite://")
+    from fastapi.testclient import TestClient
+    import main
+
+    monkeypatch.setattr(main, "Session", Session)
+    return TestClient(main.app)
+
+
+def test_endpoint_rejects_bad_cursor(client):
+    response = client.get("/api/terminals/30/90/transactions", params={"before": "garbage"})
+    assert response.status_code == 400
+
+
+def test_endpoint_pages(client, Session):
+    with Session() as db:
+        add_transaction(db, "20261019_30_90_100000", datetime(2026, 10, 19, 10))
+        add_transaction(db, "20261019_30_90_110000", datetime(2026, 10, 19, 11))
+        db.commit()
+    first = client.get("/api/terminals/30/90/transactions", params={"limit": 1}).json()
+    assert [t["transaction_id"] for t in first["transactions"]] == ["20261019_30_90_110000"]
+    second = client.get(
+        "/api/terminals/30/90/transactions", params={"limit": 1, "before": first["next_cursor"]}
+    ).json()
+    assert [t["transaction_id"] for t in second["transactions"]] == ["20261019_30_90_100000"]
+    assert second["next_cursor"] is None
+
+
+def test_reprint_includes_promotions_from_cache_and_db(client, Session, monkeypatch):
+    import main
+
+    with Session() as db:
+        db.add(TaxMaster(tax_code="T10", tax_name="標準税率", tax_rate=0.1))
+        db.add(ProductMaster(barcode="1", product_name="ボールペン", unit_price=100, tax_code="T10"))
+        db.add(PromotionMaster(promotion_id="PR001", promotion_name="2点で180円", promotion_type="MULTI_BUY",
+                               required_quantity=2, promo_price=180, start_datetime=datetime(2024, 1, 1)))
+        db.add(PromotionItem(promotion_id="PR001", barcode="1", quantity=1))
+        db.commit()
+    monkeypatch.setattr(main, "promotion_engine", PromotionEngine())
+    monkeypatch.setattr(main, "receipt_cache", ReceiptCache())
+    monkeypatch.setattr(main, "inventory_batcher", None)
+
+    item = {"barcode": "1", "product_name": "ボールペン", "unit_price": 100, "quantity": 2, "tax_code": "T10",
+            "tax_rate": 0.1, "subtotal_excl_tax": 200, "tax_amount": 20, "subtotal_incl_tax": 220}
+    purchase = client.post("/api/purchase", json={
+        "store_code": "30", "pos_machine_id": "90", "cashier_code": "CASHIER001", "cart_items": [item]
+    }).json()
+    assert purchase["total_discount_amount"] == 20
+
+    url = f"/api/transactions/{purchase['transaction_id']}"
+    cached = client.get(url).json()
+    monkeypatch.setattr(main, "receipt_cache", ReceiptCache())
+    loaded = client.get(url).json()
+    assert cached == loaded
+    assert loaded["total_discount_amount"] == 20
+    assert loaded["total_amount_excl_tax"] == 180
+    assert loaded["applied_promotions"] == [
+        {"promotion_id": "PR001", "promotion_name": "2点で180円", "applied_count": 1, "discount_amount": 20}
+    ]